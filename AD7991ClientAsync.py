@@ -1,7 +1,9 @@
 import PyTango as pt
 import sys
-from PyQt4 import QtGui
-import time
+import threading
+import numpy as np
+from PyQt4 import QtGui, QtCore
+from AD7991StripChart import StripChart
 
 
 class UpdateChannel():
@@ -16,6 +18,21 @@ class UpdateChannel():
     def attr_write(self, *arg):
         print 'Written'
 
+# Channel attributes shown in the labels
+CHANNEL_NAMES = ['channel0', 'channel1', 'channel2', 'channel3']
+
+# Label refresh interval in ms, about the display rate
+REFRESH_INTERVAL = 40
+
+# Buffered scans read in bulk for the strip chart, if the server has them.
+# One row per scan of the timestamp and the channel results.
+SCANS_NAME = 'scans'
+
+# Waveform read interval in ms. The server buffer must hold more scans than
+# are taken in this time, else the chart has gaps.
+WAVEFORM_INTERVAL = 500
+
+
 class AD7991ClientAsync(QtGui.QWidget):
 
     def __init__(self, device_name='gunlaser/devices/ad7991-0', parent=None):
@@ -29,6 +46,8 @@ class AD7991ClientAsync(QtGui.QWidget):
         self.ch2_label.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
         self.ch3_label = QtGui.QLabel('')
         self.ch3_label.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
+        self.channel_labels = {'channel0': self.ch0_label, 'channel1': self.ch1_label,
+                               'channel2': self.ch2_label, 'channel3': self.ch3_label}
 
         self.vcc_button = QtGui.QPushButton('Vcc')
         self.vcc_button.pressed.connect(self.vcc_pressed)
@@ -50,41 +69,141 @@ class AD7991ClientAsync(QtGui.QWidget):
         self.mainLayout.addWidget(QtGui.QLabel('Push for Init'), 5, 0)
         self.mainLayout.addWidget(self.init_button, 5, 1)
 
+        self.strip_chart = StripChart(len(CHANNEL_NAMES))
+        self.mainLayout.addWidget(self.strip_chart, 6, 0, 1, 2)
+
         self.setLayout(self.mainLayout)
 
-        self.device = pt.DeviceProxy(device_name)
+        # Latest value of each channel, written by the Tango callbacks and shown
+        # in the labels by refresh_labels in the GUI thread
+        self.values_lock = threading.Lock()
+        self.values = {}
+        self.read_pending = False
+        # (channel index, timestamps, values) for the strip chart, also written by the callbacks
+        self.chart_samples = []
+        self.waveform_pending = False
+        self.last_waveform_time = 0.0
 
-        attr = self.device.read_attribute('channel0')
-        print attr.value
-        self.ch0_label.setText(str(attr.value))
+        self.device = pt.DeviceProxy(device_name)
 
         apiutil = pt.ApiUtil.instance()
         apiutil.set_asynch_cb_sub_model(pt.cb_sub_model.PUSH_CALLBACK)
         print apiutil.get_asynch_cb_sub_model()
 
-        self.device.read_attribute_asynch('channel0', self.update_channel)
-        self.device.read_attribute_asynch('channel1', self.update_channel)
-        self.device.read_attribute_asynch('channel2', self.update_channel)
-        self.device.read_attribute_asynch('channel3', self.update_channel)
+        # Fill the strip chart from the buffered scans if the server has them,
+        # else from the channel values as they arrive
+        attributes = [name.lower() for name in self.device.get_attribute_list()]
+        self.bulk_chart = SCANS_NAME in attributes
+
+        # Change events if the server pushes them, else one read of all channels per refresh
+        self.event_ids = []
+        try:
+            for name in CHANNEL_NAMES:
+                self.event_ids.append(self.device.subscribe_event(name, pt.EventType.CHANGE_EVENT,
+                                                                  self.channel_event))
+            self.polling = False
+        except pt.DevFailed, e:
+            print 'Could not subscribe to change events, polling:', e
+            self.unsubscribe()
+            self.polling = True
+
+        self.waveform_timer = QtCore.QTimer(self)
+        self.waveform_timer.timeout.connect(self.read_waveforms)
+        if self.bulk_chart is True:
+            self.waveform_timer.start(WAVEFORM_INTERVAL)
+
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh_labels)
+        self.refresh_timer.start(REFRESH_INTERVAL)
 
         self.cb_obj = UpdateChannel()
 
-    def update_channel(self, arg):
-        name = arg.attr_names[0].lower()
-        attr = arg.argout
-        if name == 'channel0':
-            self.ch0_label.setText(str(attr[0].value))
-            self.device.read_attribute_asynch('channel0', self.update_channel)
-        elif name == 'channel1':
-            self.ch1_label.setText(str(attr[0].value))
-            self.device.read_attribute_asynch('channel1', self.update_channel)
-        elif name == 'channel2':
-            self.ch2_label.setText(str(attr[0].value))
-            self.device.read_attribute_asynch('channel2', self.update_channel)
-        elif name == 'channel3':
-            self.ch3_label.setText(str(attr[0].value))
-            self.device.read_attribute_asynch('channel3', self.update_channel)
-        time.sleep(0.025)
+    def unsubscribe(self):
+        for event_id in self.event_ids:
+            try:
+                self.device.unsubscribe_event(event_id)
+            except pt.DevFailed:
+                pass
+        self.event_ids = []
+
+    def closeEvent(self, event):
+        self.refresh_timer.stop()
+        self.waveform_timer.stop()
+        self.unsubscribe()
+        QtGui.QWidget.closeEvent(self, event)
+
+    def channel_event(self, event):
+        # Called from a Tango thread, only store the value
+        if event.err is True or event.attr_value is None:
+            return
+        name = event.attr_name.split('/')[-1].lower()
+        with self.values_lock:
+            self.values[name] = event.attr_value.value
+            if self.bulk_chart is False and name in CHANNEL_NAMES:
+                self.chart_samples.append((CHANNEL_NAMES.index(name), [event.attr_value.time.totime()],
+                                           [event.attr_value.value]))
+
+    def update_channels(self, arg):
+        # read_attributes_asynch callback, called from a Tango thread
+        if arg.err is False:
+            with self.values_lock:
+                for attr in arg.argout:
+                    name = attr.name.lower()
+                    self.values[name] = attr.value
+                    if self.bulk_chart is False and name in CHANNEL_NAMES:
+                        self.chart_samples.append((CHANNEL_NAMES.index(name), [attr.time.totime()], [attr.value]))
+        self.read_pending = False
+
+    def update_waveforms(self, arg):
+        # read_attributes_asynch callback for SCANS_NAME, called from a Tango thread.
+        # Only the scans newer than those of the previous read are added.
+        if arg.err is False and arg.argout[0].value is not None:
+            scans = np.asarray(arg.argout[0].value, dtype=np.float64).reshape((-1, 1 + len(CHANNEL_NAMES)))
+            timestamps = scans[:, 0]
+            new = timestamps > self.last_waveform_time
+            if np.any(new):
+                with self.values_lock:
+                    for ch in range(len(CHANNEL_NAMES)):
+                        self.chart_samples.append((ch, timestamps[new], scans[new, 1 + ch]))
+                self.last_waveform_time = timestamps[new].max()
+        self.waveform_pending = False
+
+    def read_waveforms(self):
+        # waveform_timer slot, keeps at most one waveform read in flight
+        if self.waveform_pending is True:
+            return
+        self.waveform_pending = True
+        try:
+            self.device.read_attributes_asynch([SCANS_NAME], self.update_waveforms)
+        except pt.DevFailed, e:
+            print 'Error reading waveforms:', e
+            self.waveform_pending = False
+
+    def refresh_labels(self):
+        """Show the values received since the last refresh and add the new samples
+        to the strip chart. When polling, start the next read of all channels if
+        the previous one has completed.
+        """
+        with self.values_lock:
+            values = self.values
+            self.values = {}
+            chart_samples = self.chart_samples
+            self.chart_samples = []
+        for name, value in values.items():
+            label = self.channel_labels.get(name)
+            if label is not None:
+                label.setText(str(value))
+        for ch, timestamps, chart_values in chart_samples:
+            self.strip_chart.add(ch, timestamps, chart_values)
+        if len(chart_samples) > 0:
+            self.strip_chart.update()
+        if self.polling is True and self.read_pending is False:
+            self.read_pending = True
+            try:
+                self.device.read_attributes_asynch(CHANNEL_NAMES, self.update_channels)
+            except pt.DevFailed, e:
+                print 'Error reading channels:', e
+                self.read_pending = False
 
     def vcc_pressed(self):
         print 'Vcc pressed'
@@ -5,20 +5,50 @@
 import sys
 import PyTango
 import AD7991_control as ad
+import i2c_sim
+from i2c_per import RetryPolicy
+from AD7991_buffer import ScanRingBuffer, BlockAccumulator
+from AD7991_calibration import Calibration, parse_calibration
+from AD7991_acquisition import AcquisitionThread, PooledAcquisition, BusStatistics, get_acquisition_pool
+from AD7991_recorder import Recorder
+from AD7991_profiling import StageProfiler
+from AD7991_trigger import TriggerEngine, parse_conditions, compile_conditions
+from AD7991_limits import LimitChecker, parse_limits
+from AD7991_mailbox import CommandMailbox
 import threading
 import logging
 import time
 import numpy as np
-import Queue
+import collections
 
 logging.basicConfig(format='%(asctime)s - %(module)s.   %(funcName)s - %(levelname)s - %(message)s', level=logging.INFO)
 
+# Largest scan buffer, also the max length of the waveform attributes
+MAX_BUFFER_DEPTH = 100000
+
+# Longest pre- and post-trigger windows, the captures are at most 2 * MAX_TRIGGER_WINDOW + 1 scans
+MAX_TRIGGER_WINDOW = 10000
+
+# Marks a channel with no change or archive event pushed yet
+NOT_PUSHED = object()
+
 
 class Command:
     def __init__(self, command, data=None):
         self.command = command
         self.data = data
 
+
+# Result of one A/D scan. Published by replacing AD7991DS.snapshot, never modified,
+# so attribute reads need no lock. raw and voltages hold None for an invalid scan.
+ChannelSnapshot = collections.namedtuple('ChannelSnapshot', ['timestamp', 'raw', 'voltages'])
+INVALID_VALUES = (None, None, None, None)
+
+# Last triggered capture in volts, published like ChannelSnapshot. voltages is a
+# (scans, 4) array and trigger_index the position of the trigger scan in it.
+CaptureSnapshot = collections.namedtuple('CaptureSnapshot', ['trigger_time', 'trigger_channel', 'trigger_index',
+                                                             'timestamps', 'voltages'])
+
 # ==================================================================
 #   AD7991DS Class Description:
 #
@@ -54,6 +84,8 @@ class AD7991DS(PyTango.Device_4Impl):
         with self.streamLock:
             self.info_stream(''.join(("[Device delete_device method] for device", self.get_name())))
         self.stopThread()
+        # The AD7991 controller is kept open for a warm restart if init_device
+        # follows (Init command). It is closed there if the properties changed.
 
 
 # ------------------------------------------------------------------
@@ -65,6 +97,8 @@ class AD7991DS(PyTango.Device_4Impl):
             self.info_stream(''.join(("In ", self.get_name(), "::init_device()")))
         self.set_state(PyTango.DevState.UNKNOWN)
         self.get_device_properties(self.get_device_class())
+        self.buffer_depth = max(1, min(self.buffer_depth, MAX_BUFFER_DEPTH))
+        self.oversampling = max(1, self.oversampling)
 
         # Try stopping the stateThread if it was started before. Will fail if this
         # is the initial start.
@@ -74,12 +108,64 @@ class AD7991DS(PyTango.Device_4Impl):
         except Exception, e:
             pass
 
+        self.initCalibration()
+        if self.simulate_i2c is True:
+            self.i2cBackend = i2c_sim.get_shared_backend()
+        else:
+            self.i2cBackend = None
+        self.retryPolicy = RetryPolicy(max(0, self.i2c_retries), self.i2c_retry_backoff)
+        # On Init the controller and buffers of the previous init_device are kept
+        # if they still fit the properties, see unknownHandler for the warm restart
+        device = getattr(self, 'ad7991Device', None)
+        if device is not None and (device.addr != self.i2c_address or device.backend is not self.i2cBackend or
+                                   device.bus_name != ''.join(('/dev/i2c-', str(self.i2c_bus)))):
+            self.closeDevice()
+        self.ad7991Device = getattr(self, 'ad7991Device', None)
+        if self.ad7991Device is not None:
+            self.ad7991Device.retry_policy = self.retryPolicy
+        if getattr(self, 'snapshot', None) is None:
+            self.snapshot = ChannelSnapshot(time.time(), INVALID_VALUES, INVALID_VALUES)
+        scanBuffer = getattr(self, 'scanBuffer', None)
+        if scanBuffer is None or scanBuffer.depth != self.buffer_depth:
+            self.scanBuffer = ScanRingBuffer(self.buffer_depth)
+            self.scanRefSel = None
+        # REF_SEL of the scans in scanBuffer, the buffer is cleared when it changes
+        self.scanRefSel = getattr(self, 'scanRefSel', None)
+        # Held while the calibration table is switched and the raw levels are compiled from it
+        self.calibrationLock = threading.Lock()
+        if self.scanRefSel is not None:
+            self.calibrationTable = self.calibration.get_table(self.refSelMode(self.scanRefSel))
+        # Oversampling block statistics in volts, published like snapshot
+        if getattr(self, 'blockAccumulator', None) is None:
+            self.blockAccumulator = BlockAccumulator(self.oversampling)
+            self.blockSnapshot = None
+        # Triggered capture from the scan buffer, conditions set with TriggerConditions
+        self.triggerSpecs = getattr(self, 'triggerSpecs', [])
+        self.triggerEngine = TriggerEngine(self.scanBuffer, max(0, min(self.trigger_pre_samples, MAX_TRIGGER_WINDOW)),
+                                           max(0, min(self.trigger_post_samples, MAX_TRIGGER_WINDOW)))
+        self.capture = getattr(self, 'capture', None)
+        # Channel alarm limits, checked on every scan
+        try:
+            self.channelLimits = parse_limits(self.channel_limits or [])
+        except ValueError, ex:
+            with self.streamLock:
+                self.error_stream(''.join(('Channel limits ignored: ', str(ex))))
+            self.channelLimits = []
+        self.limitChecker = LimitChecker()
+        self.updateRawLevels()
+        # Streaming recorder, created by StartRecording
+        self.recorder = None
+        # Stage profiler, installed by StartProfiling
+        self.profileLock = threading.Lock()
+        self.profiler = None
+        self.profileTimer = None
+        self.profileReport = ''
         self.attrLock = threading.Lock()
         self.eventIdList = []
         self.stateThread = threading.Thread()
         threading.Thread.__init__(self.stateThread, target=self.stateHandlerDispatcher)
 
-        self.commandQueue = Queue.Queue(100)
+        self.commandMailbox = CommandMailbox()
 
         self.stateHandlerDict = {PyTango.DevState.ON: self.onHandler,
                             PyTango.DevState.MOVING: self.onHandler,
@@ -91,8 +177,87 @@ class AD7991DS(PyTango.Device_4Impl):
 
         self.stopStateThreadFlag = False
 
+        # Channel events are pushed from the state thread, see pushChannelEvents
+        self.lastChangeValue = [NOT_PUSHED, NOT_PUSHED, NOT_PUSHED, NOT_PUSHED]
+        self.lastArchiveValue = [NOT_PUSHED, NOT_PUSHED, NOT_PUSHED, NOT_PUSHED]
+        for ch in range(4):
+            self.set_change_event(''.join(('Channel', str(ch))), True, False)
+            self.set_archive_event(''.join(('Channel', str(ch))), True, False)
+            self.set_change_event(''.join(('Channel', str(ch), 'Mean')), True, False)
+            self.set_change_event(''.join(('CaptureChannel', str(ch))), True, False)
+        self.set_change_event('State', True, False)
+        self.set_change_event('Status', True, False)
+        self.set_change_event('CaptureTimeStamps', True, False)
+        self.set_change_event('TriggerTime', True, False)
+
+        # The A/D is read in its own thread at a fixed rate, or by the worker of its bus in
+        # the process wide acquisition pool. It is resumed by onHandler.
+        if self.acquisition_mode.lower() == 'pool':
+            self.acquisitionThread = PooledAcquisition(get_acquisition_pool(), self.getController, self.processScan,
+                                                       self.acquisitionError, self.sample_rate)
+        else:
+            self.acquisitionThread = AcquisitionThread(self.acquireScan, self.processScan, self.acquisitionError,
+                                                       self.sample_rate)
+        self.acquisitionThread.start()
+
         self.stateThread.start()
 
+    def initCalibration(self):
+        """Sets up the raw to volts calibration tables from the device properties.
+        Invalid calibration properties are reported and replaced by no correction.
+        """
+        coefficients = {}
+        for mode, lines in [('vcc', self.calibration_vcc), ('ext', self.calibration_ext)]:
+            try:
+                coefficients[mode] = parse_calibration(lines or [])
+            except ValueError, ex:
+                with self.streamLock:
+                    self.error_stream(''.join(('Calibration for ', mode, ' reference ignored: ', str(ex))))
+                coefficients[mode] = parse_calibration([])
+        self.calibration = Calibration({'vcc': self.reference_voltage_vcc, 'ext': self.reference_voltage_ext},
+                                       coefficients)
+        self.calibrationTable = self.calibration.get_table('vcc')
+
+    def updateRawLevels(self):
+        """Converts the trigger levels and channel limits to raw codes with the
+        current calibration table. Called when the trigger conditions or the
+        calibration table change.
+        """
+        with self.calibrationLock:
+            table = self.calibrationTable
+            self.triggerEngine.set_conditions(compile_conditions(self.triggerSpecs, table))
+            changed = self.limitChecker.set_limits(self.channelLimits, table)
+        if changed is True:
+            self.updateAlarm()
+
+    def switchCalibration(self, refSel):
+        """Switches to the calibration table of the reference of the scans, when scans
+        read with another reference arrive. The buffered raw scans, the block in
+        progress and a capture in progress are for the old reference and are
+        dropped. Called from the acquisition thread.
+        """
+        self.scanBuffer.clear()
+        self.blockAccumulator.reset()
+        self.triggerEngine.reset()
+        with self.calibrationLock:
+            self.calibrationTable = self.calibration.get_table(self.refSelMode(refSel))
+        self.updateRawLevels()
+        self.scanRefSel = refSel
+
+    def referenceMode(self, voltageReference):
+        """Returns the calibration mode, 'ext' or 'vcc', of a VoltageReference value.
+        """
+        if str(voltageReference).lower() in ['ext', 'external']:
+            return 'ext'
+        return 'vcc'
+
+    def refSelMode(self, refSel):
+        """Returns the calibration mode, 'ext' or 'vcc', of the REF_SEL bit of a scan.
+        """
+        if refSel == 1:
+            return 'ext'
+        return 'vcc'
+
     def stateHandlerDispatcher(self):
         """Handles switch of states in the state machine thread.
         Each state handled method should exit by setting the next state,
@@ -113,8 +278,56 @@ class AD7991DS(PyTango.Device_4Impl):
         """Stops the state handler thread by setting the stopStateThreadFlag
         """
         self.stopStateThreadFlag = True
+        self.stopProfiling()
+        self.acquisitionThread.stop()
+        self.stopRecorder()
         self.stateThread.join(3)
 
+    def stopRecorder(self):
+        """Stops the recorder, if any, writing the scans not yet written.
+        """
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.stop()
+            if recorder.dropped_blocks > 0:
+                with self.streamLock:
+                    self.warn_stream(''.join(('Recording ', recorder.current_file, ' dropped ',
+                                              str(recorder.dropped_blocks), ' blocks')))
+
+    def stopProfiling(self):
+        """Removes the profiling wrappers and publishes the report. Called by
+        the profiling timer, StopProfiling and stopThread.
+        """
+        with self.profileLock:
+            profiler = self.profiler
+            if profiler is None:
+                return
+            self.profiler = None
+            if self.profileTimer is not None:
+                self.profileTimer.cancel()
+                self.profileTimer = None
+            profiler.restore()
+        self.profileReport = profiler.report_json()
+        if self.profile_dump_file != '':
+            try:
+                profiler.dump_stats(self.profile_dump_file)
+            except (IOError, OSError), ex:
+                with self.streamLock:
+                    self.error_stream(''.join(('Could not write profile to ', self.profile_dump_file, ': ', str(ex))))
+        with self.streamLock:
+            self.info_stream(''.join(('Profiling finished: ', self.profileReport)))
+
+    def closeDevice(self):
+        """Releases the i2c handle held by the AD7991 controller, if any.
+        """
+        if self.ad7991Device is not None:
+            try:
+                self.ad7991Device.close()
+            except Exception, ex:
+                with self.streamLock:
+                    self.error_stream(''.join(('Error closing ad7991 device: ', str(ex))))
+            self.ad7991Device = None
+
     def unknownHandler(self, prevState):
         """Handles the UNKNOWN state, before communication with the hardware devices
         has been established. Here all devices are initialized.
@@ -123,18 +336,33 @@ class AD7991DS(PyTango.Device_4Impl):
             self.info_stream('Entering unknownHandler')
         connectionTimeout = 1.0
         self.set_status('Connecting to AD7991 through i2c bus')
+        if self.ad7991Device is not None:
+            # Warm restart: keep the open controller, its config and the buffers
+            # if the device still answers
+            try:
+                if self.ad7991Device.verify() is True:
+                    with self.streamLock:
+                        self.info_stream('AD7991 still answering, keeping the open device')
+                    self.set_state(PyTango.DevState.INIT)
+                    return
+            except Exception, ex:
+                with self.streamLock:
+                    self.error_stream(''.join(('Warm restart failed: ', str(ex))))
+            self.closeDevice()
         while self.stopStateThreadFlag is False:
             # ADC:
             try:
                 with self.streamLock:
                     self.info_stream(''.join(('Opening ad7991 device on address ', str(self.i2c_address))))
-                self.ad7991Device = ad.AD7991Control(self.i2c_address, self.i2c_bus)
-                self.ad7991Device.write_config(self.ad7991Device.compile_config())
+                # The constructor writes the config
+                self.ad7991Device = ad.AD7991Control(self.i2c_address, self.i2c_bus, self.i2cBackend,
+                                                     self.retryPolicy)
             except Exception, ex:
                 with self.streamLock:
                     self.error_stream(''.join(('Could not connect to ad7991 on address ', str(self.i2c_address))))
                 with self.streamLock:
                     self.error_stream(str(ex))
+                self.closeDevice()
                 self.set_status('Could not connect to ad7991')
                 self.checkCommands(blockTime=connectionTimeout)
                 continue
@@ -157,23 +385,17 @@ class AD7991DS(PyTango.Device_4Impl):
                 self.set_state(PyTango.DevState.UNKNOWN)
                 break
             try:
-                self.ad_result_raw = [0, 0, 0, 0]
-                self.ad_result = [0.0, 0.0, 0.0, 0.0]
-
                 attrs = self.get_device_attr()
                 self.voltage_reference = attrs.get_w_attr_by_name('VoltageReference').get_write_value()
                 s = ''.join(('Voltage reference ', str(self.voltage_reference)))
                 self.debug_stream(s)
-                if self.voltage_reference in ['ext', 'external']:
-                    self.voltage_calib = 2.0 / 4095
+                # The calibration table follows with the first scan, see switchCalibration
+                if self.referenceMode(self.voltage_reference) == 'ext':
                     self.use_channels = [True, True, True, False]
                 else:
-                    self.voltage_calib = 3.3 / 4095
                     self.use_channels = [True, True, True, True]
 
-                self.ad7991Device.set_reference(self.voltage_reference)
-                for ch, enable in enumerate(self.use_channels):
-                    self.ad7991Device.set_channel_enable(ch, enable)
+                self.ad7991Device.configure(channels=self.use_channels, reference=self.voltage_reference)
 
 
             except Exception, ex:
@@ -188,13 +410,17 @@ class AD7991DS(PyTango.Device_4Impl):
 
     def onHandler(self, prevState):
         """Handles the ON state. Connected to the AD7991.
-        Loops reading A/D and checking commands.
+        The A/D is read by the acquisition thread while in this state,
+        the loop here only checks commands.
         """
         with self.streamLock:
             self.info_stream('Entering onHandler')
         handledstates = [PyTango.DevState.ON, PyTango.DevState.ALARM, PyTango.DevState.MOVING]
-        waittime = 0.025
+        waittime = 0.1
         self.set_status('On')
+        # Limits are evaluated again from the first scan
+        self.limitChecker.reset()
+        self.acquisitionThread.resume()
         while self.stopStateThreadFlag is False:
             # self.info_stream('onhandler loop')
             with self.attrLock:
@@ -203,25 +429,173 @@ class AD7991DS(PyTango.Device_4Impl):
                 self.info_stream(''.join(('Exit onhandler, state=', str(state), ', stopStateThreadFlag=', str(self.stopStateThreadFlag))))
                 break
 
-            # Read ad values:
-            with self.attrLock:
-                try:
-                    for ind, ch in enumerate(self.use_channels):
-                        if ch is True:
-                            data = self.ad7991Device.read_ad_result()
-                            self.ad_result_raw[data[0]] = data[1]
-                        else:
-                            self.ad_result_raw[ind] = 0
-                        # self.debug_stream('AD result ok')
-                        self.ad_result[ind] = self.ad_result_raw[ind] * self.voltage_calib
-                except Exception, ex:
-                    with self.streamLock:
-                        self.error_stream(''.join(('Error reading AD result: ', str(ex))))
-                    self.set_state(PyTango.DevState.FAULT)
-                    self.ad_result_raw = [None, None, None, None]
-                    self.ad_result = [None, None, None, None]
-
             self.checkCommands(blockTime=waittime)
+        self.acquisitionThread.pause()
+
+    def getController(self):
+        return self.ad7991Device
+
+    def getBusStatistics(self):
+        """Returns BusStatistics for the bus of this device. Without the acquisition
+        pool the bus is scanned only by this device.
+        """
+        busName = ''.join(('/dev/i2c-', str(self.i2c_bus)))
+        if isinstance(self.acquisitionThread, PooledAcquisition):
+            for stats in self.acquisitionThread.pool.bus_statistics():
+                if stats.bus_name == busName:
+                    return stats
+            return BusStatistics(busName, 0.0, 0.0, 0, 0, 0)
+        scanRate = self.acquisitionThread.achieved_rate
+        device = self.ad7991Device
+        nChannels = sum(device.channel_enable) if device is not None else 0
+        return BusStatistics(busName, scanRate, scanRate * nChannels, 0, 0, self.acquisitionThread.overruns)
+
+    def getI2CStatistics(self):
+        """Returns the I2CStatistics of the i2c bus of this device, None if the
+        device is not open. Shared by all devices on the bus.
+        """
+        device = self.ad7991Device
+        if device is None or device.bus_manager is None:
+            return None
+        return device.bus_manager.statistics
+
+    def acquireScan(self):
+        """Reads all enabled channels in one i2c transaction. Called from the
+        acquisition thread.
+        """
+        return self.ad7991Device.read_all_channels()
+
+    def processScan(self, timestamp, data):
+        """Publishes a scan from the acquisition thread as a new snapshot, buffers
+        it and pushes channel events.
+        """
+        refSel = data.ref_sel
+        if refSel is None:
+            # Read during a config write, the reference is not known
+            return
+        if refSel != self.scanRefSel:
+            self.switchCalibration(refSel)
+        raw = (data.get(0, 0), data.get(1, 0), data.get(2, 0), data.get(3, 0))
+        table = self.calibrationTable
+        voltages = table.convert_scan(raw)
+        self.snapshot = ChannelSnapshot(timestamp, raw, voltages)
+        self.scanBuffer.append(timestamp, raw)
+        capture = self.triggerEngine.add(timestamp, raw)
+        if capture is not None:
+            self.publishCapture(capture, table)
+        if self.limitChecker.check(data) is True:
+            self.updateAlarm()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.add(timestamp, raw)
+        self.pushChannelEvents(voltages, timestamp)
+
+        block = self.blockAccumulator.add(timestamp, raw, table)
+        if block is not None:
+            self.blockSnapshot = block
+            for ch in range(4):
+                self.pushEvent(self.push_change_event, ''.join(('Channel', str(ch), 'Mean')),
+                               self.blockSnapshot.mean[ch], block.timestamp)
+
+    def updateAlarm(self):
+        """Switches between ON and ALARM when the tripped channel limits changed,
+        sets the status to the tripped channels and pushes State and Status
+        events. Called from the acquisition thread.
+        """
+        description = self.limitChecker.describe()
+        with self.attrLock:
+            state = self.get_state()
+            if description != '' and state == PyTango.DevState.ON:
+                state = PyTango.DevState.ALARM
+            elif description == '' and state == PyTango.DevState.ALARM:
+                state = PyTango.DevState.ON
+            elif state not in [PyTango.DevState.ON, PyTango.DevState.ALARM]:
+                return
+            self.set_state(state)
+            if description != '':
+                status = ''.join(('Limit exceeded: ', description))
+            else:
+                status = 'On'
+            self.set_status(status)
+        with self.streamLock:
+            self.info_stream(status)
+        timestamp = time.time()
+        self.pushEvent(self.push_change_event, 'State', state, timestamp)
+        self.pushEvent(self.push_change_event, 'Status', status, timestamp)
+
+    def publishCapture(self, capture, table):
+        """Publishes a triggered capture in volts and pushes change events for
+        the capture attributes, timestamped with the trigger time.
+        """
+        snapshot = CaptureSnapshot(capture.trigger_time, capture.trigger_channel, capture.trigger_index,
+                                   capture.timestamps, table.convert(capture.raw))
+        self.capture = snapshot
+        for ch in range(4):
+            self.pushEvent(self.push_change_event, ''.join(('CaptureChannel', str(ch))),
+                           snapshot.voltages[:, ch], snapshot.trigger_time)
+        self.pushEvent(self.push_change_event, 'CaptureTimeStamps', snapshot.timestamps, snapshot.trigger_time)
+        self.pushEvent(self.push_change_event, 'TriggerTime', snapshot.trigger_time, snapshot.trigger_time)
+
+    def acquisitionError(self, ex):
+        """Called from the acquisition thread when a scan failed. The acquisition
+        is already paused. Goes to FAULT, where faultHandler tries to recover.
+        """
+        with self.streamLock:
+            self.error_stream(''.join(('Error reading AD result: ', str(ex))))
+        timestamp = time.time()
+        self.snapshot = ChannelSnapshot(timestamp, INVALID_VALUES, INVALID_VALUES)
+        with self.attrLock:
+            self.set_state(PyTango.DevState.FAULT)
+        self.pushChannelEvents(INVALID_VALUES, timestamp)
+
+    def pushChannelEvents(self, values, timestamp):
+        """Pushes change and archive events for the channels whose value moved
+        more than the configured thresholds since the last pushed event.
+        A value of None is pushed as an invalid attribute.
+        """
+        for ch, value in enumerate(values):
+            name = ''.join(('Channel', str(ch)))
+            if self.eventThresholdExceeded(value, self.lastChangeValue[ch],
+                                           self.change_abs_threshold, self.change_rel_threshold):
+                self.pushEvent(self.push_change_event, name, value, timestamp)
+                self.lastChangeValue[ch] = value
+            if self.eventThresholdExceeded(value, self.lastArchiveValue[ch],
+                                           self.archive_abs_threshold, self.archive_rel_threshold):
+                self.pushEvent(self.push_archive_event, name, value, timestamp)
+                self.lastArchiveValue[ch] = value
+
+    def eventThresholdExceeded(self, value, lastValue, absThreshold, relThreshold):
+        """Checks if value differs enough from lastValue to push an event.
+        absThreshold is in volts, relThreshold in percent of lastValue. A threshold
+        <= 0 is not used. With both thresholds unused any change is pushed.
+        """
+        if lastValue is NOT_PUSHED:
+            return True
+        if value is None or lastValue is None:
+            return value is not lastValue
+        delta = abs(value - lastValue)
+        if absThreshold <= 0 and relThreshold <= 0:
+            return delta > 0
+        if 0 < absThreshold <= delta:
+            return True
+        if relThreshold > 0 and delta * 100.0 >= relThreshold * abs(lastValue) and delta > 0:
+            return True
+        return False
+
+    def pushEvent(self, pushMethod, name, value, timestamp):
+        """Pushes one event. Errors are logged, never raised, since this is called
+        from the acquisition and state threads.
+        """
+        if value is None:
+            quality = PyTango.AttrQuality.ATTR_INVALID
+            value = 0.0
+        else:
+            quality = PyTango.AttrQuality.ATTR_VALID
+        try:
+            pushMethod(name, value, timestamp, quality)
+        except Exception, ex:
+            with self.streamLock:
+                self.error_stream(''.join(('Error pushing event for ', name, ': ', str(ex))))
 
     def faultHandler(self, prevState):
         """Handles the FAULT state. A problem has been detected.
@@ -239,10 +613,8 @@ class AD7991DS(PyTango.Device_4Impl):
             # Test ad7991:
             try:
                 with self.streamLock:
-                    self.info_stream('Reading AD result...')
-                result = self.ad7991Device.read_ad_result()
-                with self.streamLock:
-                    self.info_stream(str(result))
+                    self.info_stream('Verifying AD7991...')
+                result = self.ad7991Device.verify()
 
                 if result is False:
                     # Reconnect if the reply was bad:
@@ -251,7 +623,15 @@ class AD7991DS(PyTango.Device_4Impl):
                     self.set_state(PyTango.DevState.ON)
 
             except Exception, e:
-                self.set_state(PyTango.DevState.UNKNOWN)
+                with self.streamLock:
+                    self.error_stream(''.join(('Error reading AD result: ', str(e), ', reopening i2c device')))
+                # Try reopening the i2c device before falling back to a full reconnect
+                try:
+                    self.ad7991Device.reopen()
+                except Exception, e:
+                    with self.streamLock:
+                        self.error_stream(''.join(('Could not reopen i2c device: ', str(e))))
+                    self.set_state(PyTango.DevState.UNKNOWN)
 
             if self.get_state() == PyTango.DevState.FAULT:
                 retries += 1
@@ -267,17 +647,14 @@ class AD7991DS(PyTango.Device_4Impl):
         self.set_state(PyTango.DevState.ON)
 
     def checkCommands(self, blockTime=0):
-        """Checks the commandQueue for new commands. Must be called regularly.
-        If the queue is empty the method exits immediately.
+        """Takes all pending commands from the commandMailbox. Must be called regularly.
+        If there are none the method waits up to blockTime for one. The configuration
+        changes among the commands are written to the AD7991 in one config write.
         """
 #         with self.streamLock:
 #             self.debug_stream('Entering checkCommands')
-        try:
-            if blockTime == 0:
-                cmd = self.commandQueue.get(block=False)
-            else:
-                cmd = self.commandQueue.get(block=True, timeout=blockTime)
-
+        config = {}
+        for cmd in self.commandMailbox.get(timeout=blockTime):
             with self.streamLock:
                 self.info_stream(''.join(('Command ', str(cmd.command), ': ', str(cmd.data))))
 
@@ -298,28 +675,34 @@ class AD7991DS(PyTango.Device_4Impl):
                     self.set_state(PyTango.DevState.ON)
 
             elif cmd.command == 'writeVoltageReference':
-                if self.get_state() not in [PyTango.DevState.UNKNOWN]:
-                    self.ad7991Device.set_reference(cmd.data)
-                self.voltage_reference = cmd.data
-                if self.voltage_reference in ['ext', 'external']:
-                    self.voltage_calib = 2.0 / 4095
-                    use_channels = [True, True, True, False]
+                # Channel 3 is the reference input with an external reference
+                if self.referenceMode(cmd.data) == 'ext':
+                    channels = [True, True, True, False]
                 else:
-                    self.voltage_calib = 3.3 / 4095
-                    use_channels = [True, True, True, True]
-                cmd_msg = Command('writeUseChannels', use_channels)
-                self.commandQueue.put(cmd_msg)
+                    channels = [True, True, True, True]
+                config['reference'] = cmd.data
+                config['channels'] = channels
 
             elif cmd.command == 'writeUseChannels':
-                self.use_channels = cmd.data
-                if self.get_state() not in [PyTango.DevState.UNKNOWN]:
-                    for ch, enable in enumerate(cmd.data):
-                        self.ad7991Device.set_channel_enable(ch, enable)
+                config['channels'] = cmd.data
 
-        except Queue.Empty:
-#             with self.streamLock:
-#                 self.debug_stream('checkCommands: queue empty')
-            pass
+        if len(config) == 0:
+            return
+        if self.get_state() not in [PyTango.DevState.UNKNOWN]:
+            try:
+                self.ad7991Device.configure(**config)
+            except IOError, ex:
+                # The retries are used up, faultHandler tries to recover
+                with self.streamLock:
+                    self.error_stream(''.join(('Error writing config ', str(config), ': ', str(ex))))
+                with self.attrLock:
+                    self.set_state(PyTango.DevState.FAULT)
+                return
+        # The calibration table is switched by the acquisition thread with the first
+        # scan read with the new reference, see switchCalibration
+        if 'reference' in config:
+            self.voltage_reference = config['reference']
+        self.use_channels = config['channels']
 
 # ------------------------------------------------------------------
 #     Always excuted hook method
@@ -327,18 +710,28 @@ class AD7991DS(PyTango.Device_4Impl):
     def always_executed_hook(self):
         pass
 
+# ------------------------------------------------------------------
+#     Channel attributes
+# ------------------------------------------------------------------
+    def readChannel(self, attr, channel):
+        """Sets attr to the voltage of channel in the latest snapshot, with the
+        time of the scan as attribute time.
+        """
+        snapshot = self.snapshot
+        if self.get_logger().is_debug_enabled():
+            with self.streamLock:
+                self.debug_stream(''.join(('Reading Channel', str(channel))))
+        attr_read = snapshot.voltages[channel]
+        if attr_read is None:
+            attr.set_value_date_quality(0.0, snapshot.timestamp, PyTango.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value_date_quality(attr_read, snapshot.timestamp, PyTango.AttrQuality.ATTR_VALID)
+
 # ------------------------------------------------------------------
 #     Channel0 attribute
 # ------------------------------------------------------------------
     def read_Channel0(self, attr):
-        with self.streamLock:
-            self.info_stream(''.join(('Reading Channel0')))
-        with self.attrLock:
-            attr_read = self.ad_result[0]
-            if attr_read is None:
-                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
-                attr_read = 0.0
-            attr.set_value(attr_read)
+        self.readChannel(attr, 0)
 
     def is_Channel0_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.INIT,
@@ -352,14 +745,7 @@ class AD7991DS(PyTango.Device_4Impl):
 #     Channel1 attribute
 # ------------------------------------------------------------------
     def read_Channel1(self, attr):
-        with self.streamLock:
-            self.info_stream(''.join(('Reading Channel1')))
-        with self.attrLock:
-            attr_read = self.ad_result[1]
-            if attr_read is None:
-                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
-                attr_read = 0.0
-            attr.set_value(attr_read)
+        self.readChannel(attr, 1)
 
     def is_Channel1_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.INIT,
@@ -373,14 +759,7 @@ class AD7991DS(PyTango.Device_4Impl):
 #     Channel2 attribute
 # ------------------------------------------------------------------
     def read_Channel2(self, attr):
-        with self.streamLock:
-            self.info_stream(''.join(('Reading Channel2')))
-        with self.attrLock:
-            attr_read = self.ad_result[2]
-            if attr_read is None:
-                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
-                attr_read = 0.0
-            attr.set_value(attr_read)
+        self.readChannel(attr, 2)
 
     def is_Channel2_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.INIT,
@@ -394,14 +773,7 @@ class AD7991DS(PyTango.Device_4Impl):
 #     Channel3 attribute
 # ------------------------------------------------------------------
     def read_Channel3(self, attr):
-        with self.streamLock:
-            self.info_stream(''.join(('Reading Channel3')))
-        with self.attrLock:
-            attr_read = self.ad_result[3]
-            if attr_read is None:
-                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
-                attr_read = 0.0
-            attr.set_value(attr_read)
+        self.readChannel(attr, 3)
 
     def is_Channel3_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.INIT,
@@ -411,6 +783,303 @@ class AD7991DS(PyTango.Device_4Impl):
             return False
         return True
 
+# ------------------------------------------------------------------
+#     Channels attribute
+# ------------------------------------------------------------------
+    def read_Channels(self, attr):
+        snapshot = self.snapshot
+        if self.get_logger().is_debug_enabled():
+            with self.streamLock:
+                self.debug_stream('Reading Channels')
+        if None in snapshot.voltages:
+            attr.set_value_date_quality([0.0, 0.0, 0.0, 0.0], snapshot.timestamp,
+                                        PyTango.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value_date_quality(list(snapshot.voltages), snapshot.timestamp,
+                                        PyTango.AttrQuality.ATTR_VALID)
+
+    is_Channels_allowed = is_Channel0_allowed
+
+# ------------------------------------------------------------------
+#     Channel waveform attributes
+# ------------------------------------------------------------------
+    def readChannelWaveform(self, attr, channel):
+        """Sets attr to the buffered results of channel in volts, oldest first.
+        """
+        attr.set_value(self.calibrationTable.convert_channel(channel, self.scanBuffer.get_channel(channel)))
+
+    def read_Channel0Waveform(self, attr):
+        self.readChannelWaveform(attr, 0)
+
+    def read_Channel1Waveform(self, attr):
+        self.readChannelWaveform(attr, 1)
+
+    def read_Channel2Waveform(self, attr):
+        self.readChannelWaveform(attr, 2)
+
+    def read_Channel3Waveform(self, attr):
+        self.readChannelWaveform(attr, 3)
+
+    is_Channel0Waveform_allowed = is_Channel0_allowed
+    is_Channel1Waveform_allowed = is_Channel1_allowed
+    is_Channel2Waveform_allowed = is_Channel2_allowed
+    is_Channel3Waveform_allowed = is_Channel3_allowed
+
+# ------------------------------------------------------------------
+#     TimeStamps attribute
+# ------------------------------------------------------------------
+    def read_TimeStamps(self, attr):
+        attr.set_value(self.scanBuffer.get_timestamps())
+
+    def is_TimeStamps_allowed(self, req_type):
+        if self.get_state() in [PyTango.DevState.INIT,
+                                PyTango.DevState.UNKNOWN]:
+            return False
+        return True
+
+# ------------------------------------------------------------------
+#     Scans attribute
+# ------------------------------------------------------------------
+    def read_Scans(self, attr):
+        """Sets attr to the buffered scans, one row of timestamp and channel
+        0-3 results in volts per scan, oldest first. The rows are copied from
+        the buffer in one go, so the timestamps always match the results.
+        """
+        timestamps, raw = self.scanBuffer.get()
+        attr.set_value(np.column_stack((timestamps, self.calibrationTable.convert(raw))))
+
+    is_Scans_allowed = is_TimeStamps_allowed
+
+# ------------------------------------------------------------------
+#     SampleRate attribute
+# ------------------------------------------------------------------
+    def read_SampleRate(self, attr):
+        attr.set_value(self.acquisitionThread.sample_rate)
+
+    def write_SampleRate(self, attr):
+        data = attr.get_write_value()
+        self.info_stream(''.join(('Setting sample rate to ', str(data))))
+        if data <= 0:
+            PyTango.Except.throw_exception('AD7991DS_ValueError', 'Sample rate must be positive',
+                                           'write_SampleRate')
+        self.acquisitionThread.set_sample_rate(data)
+
+# ------------------------------------------------------------------
+#     AchievedSampleRate attribute
+# ------------------------------------------------------------------
+    def read_AchievedSampleRate(self, attr):
+        attr.set_value(self.acquisitionThread.achieved_rate)
+
+# ------------------------------------------------------------------
+#     Overruns attribute
+# ------------------------------------------------------------------
+    def read_Overruns(self, attr):
+        attr.set_value(self.acquisitionThread.overruns)
+
+# ------------------------------------------------------------------
+#     SamplePeriod, SamplePeriodStd and SampleMaxGap attributes
+# ------------------------------------------------------------------
+    def read_SamplePeriod(self, attr):
+        attr.set_value(self.acquisitionThread.sampling_statistics.mean_period)
+
+    def read_SamplePeriodStd(self, attr):
+        attr.set_value(self.acquisitionThread.sampling_statistics.std_period)
+
+    def read_SampleMaxGap(self, attr):
+        attr.set_value(self.acquisitionThread.sampling_statistics.max_gap)
+
+# ------------------------------------------------------------------
+#     BusThroughput attribute
+# ------------------------------------------------------------------
+    def read_BusThroughput(self, attr):
+        attr.set_value(self.getBusStatistics().sample_rate)
+
+# ------------------------------------------------------------------
+#     BusQueueDepth attribute
+# ------------------------------------------------------------------
+    def read_BusQueueDepth(self, attr):
+        attr.set_value(self.getBusStatistics().queue_depth)
+
+# ------------------------------------------------------------------
+#     BusDroppedScans attribute
+# ------------------------------------------------------------------
+    def read_BusDroppedScans(self, attr):
+        attr.set_value(self.getBusStatistics().dropped)
+
+# ------------------------------------------------------------------
+#     Bus transfer statistics attributes
+# ------------------------------------------------------------------
+    def readI2CStatistic(self, attr, function, default):
+        """Sets attr to function(statistics) of the i2c bus statistics, or
+        default if the device is not open.
+        """
+        stats = self.getI2CStatistics()
+        if stats is None:
+            attr.set_value_date_quality(default, time.time(), PyTango.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value(function(stats))
+
+    def read_BusLatencyP50(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.latency_percentile(50), 0.0)
+
+    def read_BusLatencyP99(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.latency_percentile(99), 0.0)
+
+    def read_TransfersPerSecond(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.transfer_rate(), 0.0)
+
+    def read_BusErrors(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.errors, 0)
+
+    def read_BusErrorTypes(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.error_summary(), '')
+
+    def read_RetriedTransfers(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.retried_transfers, 0)
+
+    def read_FailedTransfers(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.failed_transfers, 0)
+
+    def read_BusBytesRead(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.bytes_read, 0)
+
+    def read_BusBytesWritten(self, attr):
+        self.readI2CStatistic(attr, lambda stats: stats.bytes_written, 0)
+
+# ------------------------------------------------------------------
+#     TriggerConditions attribute
+# ------------------------------------------------------------------
+    def read_TriggerConditions(self, attr):
+        attr.set_value('; '.join([' '.join((str(spec.channel), spec.mode, str(spec.level)))
+                                  for spec in self.triggerSpecs]))
+
+    def write_TriggerConditions(self, attr):
+        data = attr.get_write_value()
+        with self.streamLock:
+            self.info_stream(''.join(('Setting trigger conditions to ', data)))
+        try:
+            specs = parse_conditions(data)
+        except ValueError, ex:
+            PyTango.Except.throw_exception('AD7991DS_ValueError', str(ex), 'write_TriggerConditions')
+        self.triggerSpecs = specs
+        self.updateRawLevels()
+
+# ------------------------------------------------------------------
+#     TriggerArmed attribute
+# ------------------------------------------------------------------
+    def read_TriggerArmed(self, attr):
+        attr.set_value(self.triggerEngine.armed)
+
+    def write_TriggerArmed(self, attr):
+        if attr.get_write_value() is True:
+            self.triggerEngine.arm()
+        else:
+            self.triggerEngine.disarm()
+
+# ------------------------------------------------------------------
+#     TriggerCount attribute
+# ------------------------------------------------------------------
+    def read_TriggerCount(self, attr):
+        attr.set_value(self.triggerEngine.captures)
+
+# ------------------------------------------------------------------
+#     Capture attributes, TriggerTime, TriggerChannel, CaptureChannel<N>
+#     and CaptureTimeStamps, from the last triggered capture
+# ------------------------------------------------------------------
+    def readCapture(self, attr, function, default):
+        """Sets attr to function(capture), or to default as invalid if nothing
+        has been captured.
+        """
+        capture = self.capture
+        if capture is None:
+            attr.set_value_date_quality(default, time.time(), PyTango.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value_date_quality(function(capture), capture.trigger_time, PyTango.AttrQuality.ATTR_VALID)
+
+    def read_TriggerTime(self, attr):
+        self.readCapture(attr, lambda capture: capture.trigger_time, 0.0)
+
+    def read_TriggerChannel(self, attr):
+        self.readCapture(attr, lambda capture: capture.trigger_channel, 0)
+
+    def read_CaptureTimeStamps(self, attr):
+        self.readCapture(attr, lambda capture: capture.timestamps, [])
+
+    def read_CaptureChannel0(self, attr):
+        self.readCapture(attr, lambda capture: capture.voltages[:, 0], [])
+
+    def read_CaptureChannel1(self, attr):
+        self.readCapture(attr, lambda capture: capture.voltages[:, 1], [])
+
+    def read_CaptureChannel2(self, attr):
+        self.readCapture(attr, lambda capture: capture.voltages[:, 2], [])
+
+    def read_CaptureChannel3(self, attr):
+        self.readCapture(attr, lambda capture: capture.voltages[:, 3], [])
+
+# ------------------------------------------------------------------
+#     Profiling attribute
+# ------------------------------------------------------------------
+    def read_Profiling(self, attr):
+        attr.set_value(self.profiler is not None)
+
+# ------------------------------------------------------------------
+#     ProfileReport attribute
+# ------------------------------------------------------------------
+    def read_ProfileReport(self, attr):
+        attr.set_value(self.profileReport)
+
+# ------------------------------------------------------------------
+#     Oversampling attribute
+# ------------------------------------------------------------------
+    def read_Oversampling(self, attr):
+        attr.set_value(self.blockAccumulator.block_size)
+
+    def write_Oversampling(self, attr):
+        data = attr.get_write_value()
+        self.info_stream(''.join(('Setting oversampling to ', str(data))))
+        if data < 1:
+            PyTango.Except.throw_exception('AD7991DS_ValueError', 'Oversampling must be at least 1',
+                                           'write_Oversampling')
+        # Replacing the accumulator starts a new block
+        self.blockAccumulator = BlockAccumulator(data)
+
+# ------------------------------------------------------------------
+#     Recording attribute
+# ------------------------------------------------------------------
+    def read_Recording(self, attr):
+        recorder = self.recorder
+        attr.set_value(recorder is not None and recorder.is_recording)
+
+# ------------------------------------------------------------------
+#     RecordingFile attribute
+# ------------------------------------------------------------------
+    def read_RecordingFile(self, attr):
+        recorder = self.recorder
+        attr.set_value(recorder.current_file if recorder is not None else '')
+
+# ------------------------------------------------------------------
+#     RecordingDroppedBlocks attribute
+# ------------------------------------------------------------------
+    def read_RecordingDroppedBlocks(self, attr):
+        recorder = self.recorder
+        attr.set_value(recorder.dropped_blocks if recorder is not None else 0)
+
+# ------------------------------------------------------------------
+#     Channel statistics attributes, Channel<N>Mean, Std, Min and Max.
+#     The read methods are added after the class definition.
+# ------------------------------------------------------------------
+    def readChannelStatistic(self, attr, channel, statistic):
+        """Sets attr to a statistic ('mean', 'std', 'min' or 'max') of channel
+        over the latest oversampling block, in volts.
+        """
+        block = self.blockSnapshot
+        if block is None:
+            attr.set_value_date_quality(0.0, time.time(), PyTango.AttrQuality.ATTR_INVALID)
+        else:
+            attr.set_value_date_quality(float(getattr(block, statistic)[channel]), block.timestamp,
+                                        PyTango.AttrQuality.ATTR_VALID)
+
 # ------------------------------------------------------------------
 #     VoltageReference attribute
 # ------------------------------------------------------------------
@@ -426,12 +1095,11 @@ class AD7991DS(PyTango.Device_4Impl):
 
     def write_VoltageReference(self, attr):
         self.info_stream(''.join(('Writing voltage reference')))
-        with self.attrLock:
-            data = (attr.get_write_value()).lower()
-            if data in ['external', 'ext', 'internal', 'int', 'vcc']:
-                self.info_stream(''.join(('Setting voltage reference to ', str(data))))
-                cmd_msg = Command('writeVoltageReference', data)
-                self.commandQueue.put(cmd_msg)
+        data = (attr.get_write_value()).lower()
+        if data in ['external', 'ext', 'internal', 'int', 'vcc']:
+            self.info_stream(''.join(('Setting voltage reference to ', str(data))))
+            cmd_msg = Command('writeVoltageReference', data)
+            self.commandMailbox.put(cmd_msg)
 
     def is_VoltageReference_allowed(self, req_type):
         if self.get_state() in []:
@@ -455,17 +1123,16 @@ class AD7991DS(PyTango.Device_4Impl):
 
     def write_UseChannels(self, attr):
         self.info_stream(''.join(('Writing use channel data')))
-        with self.attrLock:
-            data = attr.get_write_value()
-            if data.__len__() == 4:
-                proceed = True
-                for ch in data:
-                    if ch not in [0, 1, False, True]:
-                        proceed = False
-                if proceed == True:
-                    self.info_stream(''.join(('Setting UseChannels to ', str(data))))
-                    cmd_msg = Command('writeUseChannels', data)
-                    self.commandQueue.put(cmd_msg)
+        data = attr.get_write_value()
+        if data.__len__() == 4:
+            proceed = True
+            for ch in data:
+                if ch not in [0, 1, False, True]:
+                    proceed = False
+            if proceed == True:
+                self.info_stream(''.join(('Setting UseChannels to ', str(data))))
+                cmd_msg = Command('writeUseChannels', data)
+                self.commandMailbox.put(cmd_msg)
 
     def is_UseChannels_allowed(self, req_type):
         if self.get_state() in []:
@@ -491,7 +1158,7 @@ class AD7991DS(PyTango.Device_4Impl):
         with self.streamLock:
             self.info_stream(''.join(("In ", self.get_name(), "::On")))
         cmdMsg = Command('on')
-        self.commandQueue.put(cmdMsg)
+        self.commandMailbox.put(cmdMsg)
 
 # ---- On command State Machine -----------------
     def is_On_allowed(self):
@@ -501,6 +1168,116 @@ class AD7991DS(PyTango.Device_4Impl):
             return False
         return True
 
+# ------------------------------------------------------------------
+#     StartRecording command:
+#
+#     Description: Start recording raw scans to files in record_directory
+#
+# ------------------------------------------------------------------
+    def StartRecording(self, prefix):
+        with self.streamLock:
+            self.info_stream(''.join(("In ", self.get_name(), "::StartRecording")))
+        if prefix == '':
+            prefix = 'ad7991'
+        # A running recording is finished first, the new one starts a new file
+        self.stopRecorder()
+        recorder = Recorder(self.record_directory, prefix, max_file_size=self.record_max_file_size * 1e6,
+                            max_file_age=self.record_max_file_age)
+        try:
+            recorder.start()
+        except (IOError, OSError), ex:
+            self.recorder = None
+            PyTango.Except.throw_exception('AD7991DS_IOError', ''.join(('Could not start recording: ', str(ex))),
+                                           'StartRecording')
+        self.recorder = recorder
+
+# ------------------------------------------------------------------
+#     StopRecording command:
+#
+#     Description: Stop recording and close the recording file
+#
+# ------------------------------------------------------------------
+    def StopRecording(self):
+        with self.streamLock:
+            self.info_stream(''.join(("In ", self.get_name(), "::StopRecording")))
+        self.stopRecorder()
+
+# ------------------------------------------------------------------
+#     ResetStatistics command:
+#
+#     Description: Clear the bus transfer statistics and acquisition overruns
+#
+# ------------------------------------------------------------------
+    def ResetStatistics(self):
+        with self.streamLock:
+            self.info_stream(''.join(("In ", self.get_name(), "::ResetStatistics")))
+        stats = self.getI2CStatistics()
+        if stats is not None:
+            stats.reset()
+        self.acquisitionThread.reset_statistics()
+
+# ------------------------------------------------------------------
+#     StartProfiling command:
+#
+#     Description: Time the stages of the acquisition and i2c path for
+#                  duration seconds. The result is in ProfileReport.
+#
+# ------------------------------------------------------------------
+    def StartProfiling(self, duration):
+        with self.streamLock:
+            self.info_stream(''.join(("In ", self.get_name(), "::StartProfiling")))
+        if duration <= 0:
+            PyTango.Except.throw_exception('AD7991DS_ValueError', 'Profiling duration must be positive',
+                                           'StartProfiling')
+        self.stopProfiling()
+        profiler = StageProfiler(self.profile_dump_file != '')
+        with self.profileLock:
+            device = self.ad7991Device
+            if device is not None and device.bus_manager is not None:
+                profiler.wrap_controller(device)
+            # The pool calls the scan callback from its dispatcher thread, set when the scan is added
+            if isinstance(self.acquisitionThread, AcquisitionThread):
+                profiler.wrap(self.acquisitionThread, 'scan_function', 'scan', cprofile=True)
+                profiler.wrap(self.acquisitionThread, 'scan_callback', 'process', cprofile=True)
+            profiler.wrap(self, 'checkCommands', 'checkCommands')
+            profiler.wrap(self.commandMailbox, 'get', 'command wait')
+            profiler.wrap_lock(self, 'streamLock', 'stream lock wait')
+            for name in ['debug_stream', 'info_stream', 'warn_stream', 'error_stream']:
+                profiler.wrap(self, name, 'logging')
+            profiler.start()
+            self.profiler = profiler
+            self.profileTimer = threading.Timer(duration, self.stopProfiling)
+            self.profileTimer.daemon = True
+            self.profileTimer.start()
+
+# ------------------------------------------------------------------
+#     StopProfiling command:
+#
+#     Description: Stop profiling before the duration has passed
+#
+# ------------------------------------------------------------------
+    def StopProfiling(self):
+        with self.streamLock:
+            self.info_stream(''.join(("In ", self.get_name(), "::StopProfiling")))
+        self.stopProfiling()
+
+
+# Channel statistics read methods, read_Channel0Mean .. read_Channel3Max
+CHANNEL_STATISTICS = [('Mean', 'mean'), ('Std', 'std'), ('Min', 'min'), ('Max', 'max')]
+
+
+def makeStatisticReader(channel, statistic):
+    def readStatistic(self, attr):
+        self.readChannelStatistic(attr, channel, statistic)
+    return readStatistic
+
+for ch in range(4):
+    for attrSuffix, statistic in CHANNEL_STATISTICS:
+        name = ''.join(('Channel', str(ch), attrSuffix))
+        setattr(AD7991DS, ''.join(('read_', name)), makeStatisticReader(ch, statistic))
+        setattr(AD7991DS, ''.join(('is_', name, '_allowed')), AD7991DS.__dict__['is_Channel0_allowed'])
+del ch, attrSuffix, statistic, name
+
 
 # ==================================================================
 #
@@ -523,6 +1300,94 @@ class AD7991DSClass(PyTango.DeviceClass):
             [PyTango.DevLong,
              "I2C address the AD7991 is using",
              [0x28]],
+        'oversampling':
+            [PyTango.DevLong,
+             "Default number of scans per statistics block, used until Oversampling is written",
+             [10]],
+        'acquisition_mode':
+            [PyTango.DevString,
+             "device: scan in a thread of this device, pool: scan with one worker per i2c bus shared by all devices in the server",
+             ['device']],
+        'reference_voltage_vcc':
+            [PyTango.DevDouble,
+             "Vcc voltage, the A/D reference when VoltageReference is vcc",
+             [3.3]],
+        'reference_voltage_ext':
+            [PyTango.DevDouble,
+             "External reference voltage on Vin3, used when VoltageReference is external",
+             [2.0]],
+        'calibration_vcc':
+            [PyTango.DevVarStringArray,
+             "Calibration with vcc reference, lines of '<channel>: c0, c1, c2, ...' giving V = c0 + c1*v + c2*v^2 + ... of the nominal voltage v",
+             []],
+        'calibration_ext':
+            [PyTango.DevVarStringArray,
+             "Calibration with external reference, lines of '<channel>: c0, c1, c2, ...' as calibration_vcc",
+             []],
+        'i2c_retries':
+            [PyTango.DevLong,
+             "Retries of an i2c transfer failing with a transient error (NAK, EAGAIN, EIO...) before going to FAULT",
+             [2]],
+        'i2c_retry_backoff':
+            [PyTango.DevDouble,
+             "Wait in s before the first retry of a failed i2c transfer, doubled for each further retry",
+             [0.0005]],
+        'simulate_i2c':
+            [PyTango.DevBoolean,
+             "Use a simulated AD7991 instead of the i2c-dev device",
+             [False]],
+        'buffer_depth':
+            [PyTango.DevLong,
+             "Number of scans kept in the waveform buffer",
+             [1000]],
+        'sample_rate':
+            [PyTango.DevDouble,
+             "Default A/D scan rate in Hz, used until SampleRate is written",
+             [40.0]],
+        'change_abs_threshold':
+            [PyTango.DevDouble,
+             "Channel change in volts that triggers a change event, <= 0 to disable",
+             [0.001]],
+        'change_rel_threshold':
+            [PyTango.DevDouble,
+             "Channel change in percent that triggers a change event, <= 0 to disable",
+             [0.0]],
+        'archive_abs_threshold':
+            [PyTango.DevDouble,
+             "Channel change in volts that triggers an archive event, <= 0 to disable",
+             [0.01]],
+        'archive_rel_threshold':
+            [PyTango.DevDouble,
+             "Channel change in percent that triggers an archive event, <= 0 to disable",
+             [0.0]],
+        'channel_limits':
+            [PyTango.DevVarStringArray,
+             "Alarm limits, lines of '<channel>: <min V>, <max V>, <hysteresis V>', min or max 'none' for no limit. A tripped limit sets ALARM",
+             []],
+        'trigger_pre_samples':
+            [PyTango.DevLong,
+             "Scans before the trigger scan in a capture, at most 10000 and limited by buffer_depth",
+             [100]],
+        'trigger_post_samples':
+            [PyTango.DevLong,
+             "Scans after the trigger scan in a capture, at most 10000",
+             [100]],
+        'profile_dump_file':
+            [PyTango.DevString,
+             "File for the cProfile statistics of the acquisition thread from StartProfiling, empty for none",
+             ['']],
+        'record_directory':
+            [PyTango.DevString,
+             "Directory of the files written by StartRecording",
+             ['/tmp']],
+        'record_max_file_size':
+            [PyTango.DevDouble,
+             "Recording file size in MB that starts a new file, <= 0 to disable",
+             [100.0]],
+        'record_max_file_age':
+            [PyTango.DevDouble,
+             "Recording file age in s that starts a new file, <= 0 to disable",
+             [3600.0]],
 
     }
 
@@ -531,6 +1396,21 @@ class AD7991DSClass(PyTango.DeviceClass):
         'On':
             [[PyTango.DevVoid, ""],
             [PyTango.DevVoid, ""]],
+        'StartRecording':
+            [[PyTango.DevString, "File name prefix, empty for ad7991"],
+            [PyTango.DevVoid, ""]],
+        'StopRecording':
+            [[PyTango.DevVoid, ""],
+            [PyTango.DevVoid, ""]],
+        'ResetStatistics':
+            [[PyTango.DevVoid, ""],
+            [PyTango.DevVoid, ""]],
+        'StartProfiling':
+            [[PyTango.DevDouble, "Profiling duration in s"],
+            [PyTango.DevVoid, ""]],
+        'StopProfiling':
+            [[PyTango.DevVoid, ""],
+            [PyTango.DevVoid, ""]],
             }
 
     #     Attribute definitions
@@ -567,6 +1447,264 @@ class AD7991DSClass(PyTango.DeviceClass):
                 'description': "A/D result for channel 3",
                 'unit': 'V',
             }],
+        'Channels':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 4],
+            {
+                'description': "A/D results for channels 0-3 from the same scan",
+                'unit': 'V',
+            }],
+        'Channel0Waveform':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, MAX_BUFFER_DEPTH],
+            {
+                'description': "Buffered A/D results for channel 0, oldest first",
+                'unit': 'V',
+            }],
+        'Channel1Waveform':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, MAX_BUFFER_DEPTH],
+            {
+                'description': "Buffered A/D results for channel 1, oldest first",
+                'unit': 'V',
+            }],
+        'Channel2Waveform':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, MAX_BUFFER_DEPTH],
+            {
+                'description': "Buffered A/D results for channel 2, oldest first",
+                'unit': 'V',
+            }],
+        'Channel3Waveform':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, MAX_BUFFER_DEPTH],
+            {
+                'description': "Buffered A/D results for channel 3, oldest first",
+                'unit': 'V',
+            }],
+        'TimeStamps':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, MAX_BUFFER_DEPTH],
+            {
+                'description': "Time of the buffered A/D results, oldest first",
+                'unit': 's',
+            }],
+        'Scans':
+            [[PyTango.DevDouble,
+            PyTango.IMAGE,
+            PyTango.READ, 5, MAX_BUFFER_DEPTH],
+            {
+                'description': "Buffered scans, oldest first. One row per scan of the time in s and the A/D results for channels 0-3 in V",
+            }],
+        'SampleRate':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ_WRITE],
+            {
+                'description': "Rate of A/D scans of all enabled channels",
+                'unit': 'Hz',
+                'Memorized': "true",
+            }],
+        'AchievedSampleRate':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Measured rate of A/D scans",
+                'unit': 'Hz',
+            }],
+        'Overruns':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Number of scans that finished after the next scan was due",
+            }],
+        'SamplePeriod':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Mean time between scan timestamps over the last second",
+                'unit': 's',
+            }],
+        'SamplePeriodStd':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Standard deviation of the time between scan timestamps over the last second",
+                'unit': 's',
+            }],
+        'SampleMaxGap':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Longest time between scan timestamps over the last second",
+                'unit': 's',
+            }],
+        'BusThroughput':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "A/D conversions per second read on the i2c bus of this device",
+                'unit': '1/s',
+            }],
+        'BusQueueDepth':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Scans of the i2c bus waiting for dispatch in the acquisition pool",
+            }],
+        'BusDroppedScans':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Scans of the i2c bus dropped because the acquisition pool queue was full",
+            }],
+        'BusLatencyP50':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Median duration of the i2c transfers on the bus of this device",
+                'unit': 's',
+            }],
+        'BusLatencyP99':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "99th percentile duration of the i2c transfers on the bus of this device",
+                'unit': 's',
+            }],
+        'TransfersPerSecond':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Successful i2c transfers per second on the bus of this device",
+                'unit': '1/s',
+            }],
+        'BusErrors':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Failed i2c transfers on the bus of this device",
+            }],
+        'BusErrorTypes':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Failed i2c transfers by errno, e.g. EIO: 3, ENXIO: 1",
+            }],
+        'RetriedTransfers':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Failed i2c transfers retried on the bus of this device, see i2c_retries",
+            }],
+        'FailedTransfers':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "i2c transfers on the bus of this device that failed after all retries",
+            }],
+        'BusBytesRead':
+            [[PyTango.DevLong64,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Bytes read in i2c transfers on the bus of this device",
+            }],
+        'BusBytesWritten':
+            [[PyTango.DevLong64,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Bytes written in i2c transfers on the bus of this device",
+            }],
+        'TriggerConditions':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ_WRITE],
+            {
+                'description': "Trigger conditions '<channel> <above|below|rising|falling> <level V>' separated by ';', empty for none",
+                'Memorized': "true",
+            }],
+        'TriggerArmed':
+            [[PyTango.DevBoolean,
+            PyTango.SCALAR,
+            PyTango.READ_WRITE],
+            {
+                'description': "True while waiting for a trigger, re-armed after each capture",
+            }],
+        'TriggerCount':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Number of triggered captures",
+            }],
+        'TriggerTime':
+            [[PyTango.DevDouble,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Time of the trigger scan of the last capture",
+                'unit': 's',
+            }],
+        'TriggerChannel':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Channel that fired the trigger of the last capture",
+            }],
+        'CaptureTimeStamps':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 2 * MAX_TRIGGER_WINDOW + 1],
+            {
+                'description': "Time of the scans in the last capture, trigger_pre_samples before the trigger scan",
+                'unit': 's',
+            }],
+        'Profiling':
+            [[PyTango.DevBoolean,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "True while StartProfiling is timing the acquisition stages",
+            }],
+        'ProfileReport':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "JSON of the last profiling run, count, total, mean, p50 and p99 in s per stage",
+            }],
+        'Oversampling':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ_WRITE],
+            {
+                'description': "Number of scans in each block of the channel statistics",
+                'Memorized': "true",
+            }],
         'VoltageReference':
             [[PyTango.DevString,
             PyTango.SCALAR,
@@ -576,10 +1714,55 @@ class AD7991DSClass(PyTango.DeviceClass):
                 'unit': '',
                 'Memorized': "true",
             }],
+        'Recording':
+            [[PyTango.DevBoolean,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "True while raw scans are recorded to file",
+            }],
+        'RecordingFile':
+            [[PyTango.DevString,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "File of the current or last recording",
+            }],
+        'RecordingDroppedBlocks':
+            [[PyTango.DevLong,
+            PyTango.SCALAR,
+            PyTango.READ],
+            {
+                'description': "Blocks of scans not recorded because the file writer fell behind",
+            }],
 
 
         }
 
+    # Triggered capture attributes
+    for ch in range(4):
+        attr_list[''.join(('CaptureChannel', str(ch)))] = \
+            [[PyTango.DevDouble,
+              PyTango.SPECTRUM,
+              PyTango.READ, 2 * MAX_TRIGGER_WINDOW + 1],
+             {
+                 'description': ''.join(('Channel ', str(ch), ' results of the last triggered capture')),
+                 'unit': 'V',
+             }]
+
+    # Channel statistics attributes
+    for ch in range(4):
+        for attrSuffix, statistic in CHANNEL_STATISTICS:
+            attr_list[''.join(('Channel', str(ch), attrSuffix))] = \
+                [[PyTango.DevDouble,
+                  PyTango.SCALAR,
+                  PyTango.READ],
+                 {
+                     'description': ''.join(('Oversampling block ', statistic, ' for channel ', str(ch))),
+                     'unit': 'V',
+                 }]
+    del ch, attrSuffix, statistic
+
 # ------------------------------------------------------------------
 #     AD7991DSClass Constructor
 # ------------------------------------------------------------------
@@ -0,0 +1,140 @@
+"""Created on 18 oct 2026
+
+Strip chart widget for AD7991ClientAsync.
+
+Samples are reduced to min/max per time bin as they arrive, in a NumPy ring
+buffer per channel. Drawing reduces the fixed number of bins to one min/max
+line per pixel column, so the drawing cost does not depend on the sample
+rate or on how long the chart has been running.
+
+@author: Filip Lindau
+"""
+import numpy as np
+from PyQt4 import QtGui, QtCore
+
+
+class MinMaxRingBuffer(object):
+    def __init__(self, n_bins=14400, bin_time=0.25):
+        """
+        Ring buffer of the min and max sample value in each of n_bins
+        consecutive time bins of bin_time s. Samples older than the oldest
+        bin are dropped.
+
+        :param n_bins: number of bins, the chart span is n_bins * bin_time
+        :param bin_time: bin width in s
+        """
+        self.n_bins = int(n_bins)
+        self.bin_time = bin_time
+        self.mins = np.empty(self.n_bins)
+        self.maxs = np.empty(self.n_bins)
+        self.last_bin = None    # Absolute number of the newest bin
+        self.clear()
+
+    def clear(self):
+        self.mins.fill(np.nan)
+        self.maxs.fill(np.nan)
+        self.last_bin = None
+
+    def add(self, timestamps, values):
+        """
+        Add samples, in any order.
+
+        :param timestamps: sequence of sample times in s
+        :param values: sequence of sample values
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).ravel()
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if timestamps.size == 0:
+            return
+        bins = np.floor(timestamps / self.bin_time).astype(np.int64)
+        newest = int(bins.max())
+        if self.last_bin is None:
+            self.last_bin = newest
+        elif newest > self.last_bin:
+            if newest - self.last_bin >= self.n_bins:
+                self.mins.fill(np.nan)
+                self.maxs.fill(np.nan)
+            else:
+                expired = np.arange(self.last_bin + 1, newest + 1) % self.n_bins
+                self.mins[expired] = np.nan
+                self.maxs[expired] = np.nan
+            self.last_bin = newest
+        keep = bins > self.last_bin - self.n_bins
+        slots = bins[keep] % self.n_bins
+        np.fmin.at(self.mins, slots, values[keep])
+        np.fmax.at(self.maxs, slots, values[keep])
+
+    def columns(self, width, end_bin):
+        """
+        Reduce the bins ending with end_bin to width columns.
+
+        :param width: number of columns
+        :param end_bin: absolute bin number of the last column
+        :return: tuple of min and max arrays of length width, NaN for empty columns
+        """
+        absolute = np.arange(end_bin - self.n_bins + 1, end_bin + 1)
+        mins = np.empty(self.n_bins)
+        maxs = np.empty(self.n_bins)
+        mins.fill(np.nan)
+        maxs.fill(np.nan)
+        if self.last_bin is not None:
+            valid = (absolute > self.last_bin - self.n_bins) & (absolute <= self.last_bin)
+            slots = absolute[valid] % self.n_bins
+            mins[valid] = self.mins[slots]
+            maxs[valid] = self.maxs[slots]
+        edges = np.linspace(0, self.n_bins, width + 1).astype(np.int64)[:-1]
+        return np.fmin.reduceat(mins, edges), np.fmax.reduceat(maxs, edges)
+
+
+class StripChart(QtGui.QWidget):
+    colors = [QtCore.Qt.blue, QtCore.Qt.red, QtCore.Qt.darkGreen, QtCore.Qt.magenta]
+
+    def __init__(self, n_channels=4, n_bins=14400, bin_time=0.25, parent=None):
+        """
+        Strip chart of n_channels, spanning n_bins * bin_time s ending at the
+        newest sample. The y axis scales to the visible data.
+        """
+        QtGui.QWidget.__init__(self, parent)
+        self.buffers = [MinMaxRingBuffer(n_bins, bin_time) for ch in range(n_channels)]
+        self.setMinimumSize(200, 120)
+        self.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
+
+    def add(self, channel, timestamps, values):
+        self.buffers[channel].add(timestamps, values)
+
+    def clear(self):
+        for buffer in self.buffers:
+            buffer.clear()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.white)
+        last_bins = [b.last_bin for b in self.buffers if b.last_bin is not None]
+        width = self.width()
+        height = self.height()
+        if len(last_bins) == 0 or width < 2 or height < 2:
+            return
+        end_bin = max(last_bins)
+        columns = [b.columns(width, end_bin) for b in self.buffers]
+        lows = [np.nanmin(mins) for mins, maxs in columns if np.any(np.isfinite(mins))]
+        highs = [np.nanmax(maxs) for mins, maxs in columns if np.any(np.isfinite(maxs))]
+        if len(lows) == 0:
+            return
+        low = min(lows)
+        high = max(highs)
+        if high - low < 1e-6:
+            low -= 0.5
+            high += 0.5
+        scale = (height - 1) / (high - low)
+
+        painter.setPen(QtCore.Qt.gray)
+        painter.drawText(2, 12, '%.3f V' % high)
+        painter.drawText(2, height - 2, '%.3f V' % low)
+        for ch, (mins, maxs) in enumerate(columns):
+            painter.setPen(self.colors[ch % len(self.colors)])
+            x = np.nonzero(np.isfinite(mins))[0]
+            y_top = (height - 1) - (maxs[x] - low) * scale
+            y_bottom = (height - 1) - (mins[x] - low) * scale
+            # One vertical line per pixel column, at least one pixel high
+            painter.drawLines([QtCore.QLineF(x[i], y_top[i], x[i], y_bottom[i] + 1) for i in range(x.size)])
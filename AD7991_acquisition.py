@@ -0,0 +1,487 @@
+"""Created on 18 oct 2026
+
+Fixed rate acquisition thread for the AD7991.
+
+@author: Filip Lindau
+"""
+import threading
+import time
+import math
+import logging
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from AD7991_clock import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Spacing of the scan timestamps over the last rate interval, in seconds
+SamplingStatistics = collections.namedtuple('SamplingStatistics', ['mean_period', 'std_period', 'max_gap'])
+NO_SAMPLING_STATISTICS = SamplingStatistics(0.0, 0.0, 0.0)
+
+
+class AcquisitionThread(object):
+    # Longest single sleep, so that stop() and pause() are honoured quickly at low rates
+    max_sleep = 0.1
+    # Interval for updating the achieved sample rate
+    rate_interval = 1.0
+
+    def __init__(self, scan_function, scan_callback, error_callback=None, sample_rate=40.0):
+        """
+        Runs scan_function at a fixed rate in a separate thread. The scan times
+        are scheduled on absolute deadlines, so the time spent scanning and in
+        the callbacks does not make the rate drift. A scan that finishes after
+        the next deadline is counted as an overrun and the missed deadlines are
+        skipped.
+
+        Each scan is timestamped with the midpoint of the monotonic clock
+        readings just before and after scan_function, mapped to wall clock
+        time with an offset taken when scanning is resumed. The spacing of the
+        timestamps is published every rate_interval in sampling_statistics.
+
+        The thread starts paused, call resume() to start scanning.
+
+        :param scan_function: called without arguments for each scan, returns the scan data
+        :param scan_callback: called as scan_callback(timestamp, data) after each scan,
+            timestamp in seconds since epoch
+        :param error_callback: called as error_callback(exception) if scan_function
+            raises. The acquisition is paused before the call.
+        :param sample_rate: scans per second
+        """
+        self.scan_function = scan_function
+        self.scan_callback = scan_callback
+        self.error_callback = error_callback
+        self.sample_rate = None
+        self.set_sample_rate(sample_rate)
+
+        self.overruns = 0
+        self.achieved_rate = 0.0
+        self.sampling_statistics = NO_SAMPLING_STATISTICS
+
+        self._run_event = threading.Event()
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._run, name='AD7991 acquisition')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=3.0):
+        self.request_stop()
+        self.join(timeout)
+
+    def request_stop(self):
+        """
+        Make the thread exit after the scan in progress, without waiting for it.
+        """
+        self._stop_flag = True
+        self._run_event.set()
+
+    def join(self, timeout=3.0):
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def resume(self):
+        """
+        Start scanning. Scheduling restarts from the current time.
+        """
+        self._run_event.set()
+
+    def pause(self):
+        """
+        Stop scanning after the scan in progress.
+        """
+        self._run_event.clear()
+
+    def is_running(self):
+        return self._run_event.is_set() and not self._stop_flag
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def set_sample_rate(self, sample_rate):
+        if sample_rate <= 0:
+            raise ValueError('Sample rate must be positive')
+        self.sample_rate = float(sample_rate)
+
+    def reset_statistics(self):
+        self.overruns = 0
+        self.achieved_rate = 0.0
+        self.sampling_statistics = NO_SAMPLING_STATISTICS
+
+    def _run(self):
+        while self._stop_flag is False:
+            if self._run_event.is_set() is False:
+                self._run_event.wait(self.max_sleep)
+                continue
+
+            # Fixed while running, so the timestamps keep the monotonic spacing
+            wall_offset = time.time() - monotonic()
+            next_deadline = monotonic()
+            rate_start = next_deadline
+            rate_scans = 0
+            last_scan_time = None
+            n_periods = 0
+            period_sum = 0.0
+            period_sum2 = 0.0
+            max_gap = 0.0
+            while self._stop_flag is False and self._run_event.is_set() is True:
+                try:
+                    t_start = monotonic()
+                    data = self.scan_function()
+                    scan_time = 0.5 * (t_start + monotonic())
+                    self.scan_callback(scan_time + wall_offset, data)
+                except Exception as ex:
+                    self.pause()
+                    logger.error(''.join(('Acquisition error: ', str(ex))))
+                    if self.error_callback is not None:
+                        self.error_callback(ex)
+                    break
+
+                period = 1.0 / self.sample_rate
+                next_deadline += period
+                now = monotonic()
+
+                rate_scans += 1
+                if last_scan_time is not None:
+                    gap = scan_time - last_scan_time
+                    n_periods += 1
+                    period_sum += gap
+                    period_sum2 += gap * gap
+                    max_gap = max(max_gap, gap)
+                last_scan_time = scan_time
+                if now - rate_start >= self.rate_interval:
+                    self.achieved_rate = rate_scans / (now - rate_start)
+                    if n_periods > 0:
+                        mean_period = period_sum / n_periods
+                        variance = max(period_sum2 / n_periods - mean_period * mean_period, 0.0)
+                        self.sampling_statistics = SamplingStatistics(mean_period, math.sqrt(variance), max_gap)
+                    rate_start = now
+                    rate_scans = 0
+                    n_periods = 0
+                    period_sum = 0.0
+                    period_sum2 = 0.0
+                    max_gap = 0.0
+
+                if now > next_deadline:
+                    # Overrun, skip the deadlines already passed but keep the phase
+                    self.overruns += 1
+                    next_deadline += period * (int((now - next_deadline) / period) + 1)
+                self._sleep_until(next_deadline)
+            self.achieved_rate = 0.0
+            self.sampling_statistics = NO_SAMPLING_STATISTICS
+
+    def _sleep_until(self, deadline):
+        while self._stop_flag is False and self._run_event.is_set() is True:
+            delay = deadline - monotonic()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, self.max_sleep))
+
+
+# Acquisition statistics of one bus in a BusAcquisitionPool
+BusStatistics = collections.namedtuple('BusStatistics', ['bus_name', 'scan_rate', 'sample_rate', 'queue_depth',
+                                                         'dropped', 'overruns'])
+
+
+class _BusWorker(object):
+    def __init__(self, pool, manager, sample_rate):
+        """
+        Scans all subscribed controllers of one bus in a combined transfer
+        (I2CBusManager.scan) and hands the results to the pool queue.
+        """
+        self.pool = pool
+        self.manager = manager
+        self.subscriptions = {}     # controller: (scan_callback, error_callback, sample_rate)
+        self.lock = threading.Lock()
+        self.pending = 0            # Scans of this bus waiting in the pool queue
+        self.dropped = 0
+        self.sample_rate = 0.0      # Conversions per second
+        self._rate_start = monotonic()
+        self._rate_samples = 0
+        self.acquisition = AcquisitionThread(self.scan, self.enqueue, self.error, sample_rate)
+
+    def scan(self):
+        with self.lock:
+            controllers = list(self.subscriptions.keys())
+        return self.manager.scan(controllers)
+
+    def enqueue(self, timestamp, results):
+        n_samples = 0
+        for result in results.values():
+            if isinstance(result, dict):
+                n_samples += len(result)
+        with self.lock:
+            try:
+                self.pool.queue.put_nowait((timestamp, self, results))
+                self.pending += 1
+            except queue.Full:
+                self.dropped += 1
+            self._rate_samples += n_samples
+            now = monotonic()
+            if now - self._rate_start >= self.acquisition.rate_interval:
+                self.sample_rate = self._rate_samples / (now - self._rate_start)
+                self._rate_start = now
+                self._rate_samples = 0
+
+    def error(self, ex):
+        # Scan failed as a whole, report to every subscriber
+        with self.lock:
+            subscriptions = list(self.subscriptions.items())
+        for controller, subscription in subscriptions:
+            self.pool.remove(controller)
+            if subscription[1] is not None:
+                subscription[1](ex)
+
+    def update_rate(self):
+        # Scan at the highest rate requested by a subscriber. Call with lock held.
+        if len(self.subscriptions) > 0:
+            self.acquisition.set_sample_rate(max([s[2] for s in self.subscriptions.values()]))
+
+
+class BusAcquisitionPool(object):
+    def __init__(self, queue_size=1000):
+        """
+        Acquisition with one worker thread per i2c bus, so a slow bus does not
+        stall the others. Each worker scans all controllers subscribed on its
+        bus in a combined transfer at the highest requested rate. The
+        timestamped results of all buses are merged into one queue, and a
+        dispatcher thread passes them on to the subscriber callbacks. If the
+        queue is full, scans are dropped and counted per bus.
+
+        :param queue_size: max number of scans waiting for dispatch
+        """
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.workers = {}       # I2CBusManager: _BusWorker
+        self._stopping = []     # Removed workers, joined in stop()
+        self.listeners = []
+        self._stop_flag = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name='AD7991 acquisition dispatcher')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def add(self, controller, scan_callback, error_callback=None, sample_rate=40.0):
+        """
+        Start scanning controller on its bus worker. Results are delivered as
+        scan_callback(timestamp, data) with data the channel: raw ad dict. If a
+        scan of the controller fails it is removed from the pool and
+        error_callback(exception) is called.
+        """
+        manager = controller.bus_manager
+        if manager is None:
+            raise ValueError('Controller is not open')
+        with self.lock:
+            worker = self.workers.get(manager)
+            if worker is None:
+                worker = _BusWorker(self, manager, sample_rate)
+                self.workers[manager] = worker
+                worker.acquisition.start()
+            with worker.lock:
+                worker.subscriptions[controller] = (scan_callback, error_callback, sample_rate)
+                worker.update_rate()
+            worker.acquisition.resume()
+
+    def remove(self, controller):
+        """
+        Stop scanning controller. The bus worker is stopped when its last
+        controller is removed.
+        """
+        stopped_worker = None
+        with self.lock:
+            for manager, worker in self.workers.items():
+                with worker.lock:
+                    if controller not in worker.subscriptions:
+                        continue
+                    del worker.subscriptions[controller]
+                    worker.update_rate()
+                    empty = len(worker.subscriptions) == 0
+                if empty is True:
+                    del self.workers[manager]
+                    stopped_worker = worker
+                break
+        # Only signal the worker thread. remove is called from the dispatcher, which
+        # must not wait for a worker stuck on a hung bus while the other buses deliver.
+        if stopped_worker is not None:
+            stopped_worker.acquisition.request_stop()
+            with self.lock:
+                self._stopping = [w for w in self._stopping if w.acquisition.is_alive()]
+                self._stopping.append(stopped_worker)
+
+    def set_sample_rate(self, controller, sample_rate):
+        with self.lock:
+            for worker in self.workers.values():
+                with worker.lock:
+                    if controller in worker.subscriptions:
+                        scan_callback, error_callback, old_rate = worker.subscriptions[controller]
+                        worker.subscriptions[controller] = (scan_callback, error_callback, sample_rate)
+                        worker.update_rate()
+                        return
+
+    def add_listener(self, listener):
+        """
+        Add a listener to the merged stream of all buses. It is called from the
+        dispatcher thread as listener(timestamp, bus_name, address, data) for
+        every successful device scan.
+        """
+        with self.lock:
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners = [l for l in self.listeners if l is not listener]
+
+    def get_worker(self, controller):
+        with self.lock:
+            for worker in self.workers.values():
+                if controller in worker.subscriptions:
+                    return worker
+        return None
+
+    def bus_statistics(self):
+        """
+        :return: list of BusStatistics, one per active bus
+        """
+        with self.lock:
+            workers = list(self.workers.values())
+        return [BusStatistics(w.manager.bus_name, w.acquisition.achieved_rate, w.sample_rate, w.pending,
+                              w.dropped, w.acquisition.overruns) for w in workers]
+
+    def stop(self):
+        with self.lock:
+            workers = list(self.workers.values()) + self._stopping
+            self.workers = {}
+            self._stopping = []
+        for worker in workers:
+            worker.acquisition.stop()
+        self._stop_flag = True
+        self._dispatcher.join(3)
+
+    def _dispatch(self):
+        while self._stop_flag is False:
+            try:
+                timestamp, worker, results = self.queue.get(True, 0.1)
+            except queue.Empty:
+                continue
+            with worker.lock:
+                worker.pending -= 1
+                subscriptions = dict([(c.addr, (c, s)) for c, s in worker.subscriptions.items()])
+            listeners = self.listeners
+            for address, result in results.items():
+                if len(listeners) > 0 and isinstance(result, dict):
+                    for listener in listeners:
+                        try:
+                            listener(timestamp, worker.manager.bus_name, address, result)
+                        except Exception as ex:
+                            logger.error(''.join(('Error in acquisition listener: ', str(ex))))
+                if address not in subscriptions:
+                    continue
+                controller, (scan_callback, error_callback, sample_rate) = subscriptions[address]
+                try:
+                    if isinstance(result, Exception):
+                        self.remove(controller)
+                        if error_callback is not None:
+                            error_callback(result)
+                    else:
+                        scan_callback(timestamp, result)
+                except Exception as ex:
+                    logger.error(''.join(('Error in acquisition callback: ', str(ex))))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_acquisition_pool():
+    """
+    Get the process wide BusAcquisitionPool, created on first use.
+
+    :rtype: BusAcquisitionPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BusAcquisitionPool()
+        return _pool
+
+
+class PooledAcquisition(object):
+    def __init__(self, pool, controller_function, scan_callback, error_callback=None, sample_rate=40.0):
+        """
+        Acquisition of one controller in a BusAcquisitionPool, with the same
+        interface as AcquisitionThread. Scanning starts when resume() is called.
+
+        :param pool: BusAcquisitionPool
+        :param controller_function: called without arguments, returns the AD7991Control to scan
+        :param scan_callback: called as scan_callback(timestamp, data) after each scan
+        :param error_callback: called as error_callback(exception) if a scan failed.
+            The acquisition is paused before the call.
+        :param sample_rate: requested scans per second. The bus is scanned at the
+            highest rate requested on it.
+        """
+        self.pool = pool
+        self.controller_function = controller_function
+        self.scan_callback = scan_callback
+        self.error_callback = error_callback
+        self._controller = None
+        self.sample_rate = None
+        self.set_sample_rate(sample_rate)
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=3.0):
+        self.pause()
+
+    def resume(self):
+        self.pause()
+        self._controller = self.controller_function()
+        self.pool.add(self._controller, self.scan_callback, self._error, self.sample_rate)
+
+    def pause(self):
+        if self._controller is not None:
+            self.pool.remove(self._controller)
+            self._controller = None
+
+    def is_running(self):
+        return self._controller is not None
+
+    def set_sample_rate(self, sample_rate):
+        if sample_rate <= 0:
+            raise ValueError('Sample rate must be positive')
+        self.sample_rate = float(sample_rate)
+        if self._controller is not None:
+            self.pool.set_sample_rate(self._controller, self.sample_rate)
+
+    def reset_statistics(self):
+        worker = self._worker()
+        if worker is not None:
+            worker.acquisition.reset_statistics()
+
+    @property
+    def achieved_rate(self):
+        worker = self._worker()
+        return worker.acquisition.achieved_rate if worker is not None else 0.0
+
+    @property
+    def overruns(self):
+        worker = self._worker()
+        return worker.acquisition.overruns if worker is not None else 0
+
+    @property
+    def sampling_statistics(self):
+        worker = self._worker()
+        return worker.acquisition.sampling_statistics if worker is not None else NO_SAMPLING_STATISTICS
+
+    def _worker(self):
+        if self._controller is None:
+            return None
+        return self.pool.get_worker(self._controller)
+
+    def _error(self, ex):
+        self._controller = None
+        if self.error_callback is not None:
+            self.error_callback(ex)
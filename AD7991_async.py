@@ -0,0 +1,191 @@
+"""Created on 18 oct 2026
+
+asyncio interface to i2c_per and AD7991Control, for python 3.
+
+The blocking i2c transfers run in a bounded thread pool executor so the event
+loop is never stalled. Both classes go through the shared I2CBusManager of
+their bus, and transfers on the same bus are serialized with an asyncio lock
+per bus manager before they reach the executor, so a slow bus occupies at
+most one executor thread and the other buses keep running.
+
+    async def main():
+        ad7991 = await AsyncAD7991Control.create(0x28, 1)
+        async for timestamp, data in ad7991.scans(100.0, count=1000):
+            print(timestamp, data)
+        await ad7991.close()
+
+@author: Filip Lindau
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+import weakref
+
+from AD7991_control import AD7991Control, acquire_bus, release_bus
+
+# Default number of executor threads, the number of buses that can transfer at the same time
+DEFAULT_MAX_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+# Event loop: {I2CBusManager: asyncio.Lock}, entries go away with their loop or bus manager
+_bus_locks = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    """
+    Get the executor shared by the async classes when none is given, created
+    on first use with DEFAULT_MAX_WORKERS threads.
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS,
+                                                              thread_name_prefix='AD7991 i2c')
+        return _executor
+
+
+def _get_bus_lock(manager):
+    # One asyncio lock per bus manager and event loop
+    loop = asyncio.get_running_loop()
+    locks = _bus_locks.get(loop)
+    if locks is None:
+        locks = weakref.WeakKeyDictionary()
+        _bus_locks[loop] = locks
+    lock = locks.get(manager)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[manager] = lock
+    return lock
+
+
+async def _run_serialized(manager, executor, function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    async with _get_bus_lock(manager):
+        return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+
+class AsyncI2C(object):
+    def __init__(self, devpath, backend=None, executor=None):
+        """
+        asyncio wrapper of the i2c-dev device of a bus. The device is shared
+        through the I2CBusManager of the bus, so transfers are serialized with
+        those of the AD7991Control and AsyncAD7991Control instances on the same
+        bus. Opening the device is blocking, use the create coroutine from
+        async code.
+
+        :param devpath: i2c-dev device path
+        :param backend: i2c_per backend, None for the default backend
+        :param executor: executor for the blocking calls, None for get_executor()
+        """
+        self.bus_manager = acquire_bus(devpath, backend)
+        self.executor = executor if executor is not None else get_executor()
+
+    @classmethod
+    async def create(cls, devpath, backend=None, executor=None):
+        if executor is None:
+            executor = get_executor()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(cls, devpath, backend, executor))
+
+    async def transfer(self, address, messages):
+        """
+        Transfer messages to address, see I2C.transfer.
+        """
+        await _run_serialized(self.bus_manager, self.executor, self.bus_manager.transfer, address, messages)
+
+    async def transfer_prepared(self, prepared):
+        """
+        Run an I2C.PreparedTransfer, see I2C.transfer_prepared.
+        """
+        await _run_serialized(self.bus_manager, self.executor, self.bus_manager.transfer_prepared, prepared)
+
+    async def close(self):
+        """
+        Release the bus manager. The device file is closed when no other user
+        of the bus is left.
+        """
+        if self.bus_manager is not None:
+            manager = self.bus_manager
+            self.bus_manager = None
+            await _run_serialized(manager, self.executor, release_bus, manager)
+
+
+class AsyncAD7991Control(object):
+    def __init__(self, control, executor=None):
+        """
+        asyncio wrapper of an AD7991Control. Create instances with the create
+        coroutine, which opens the device without blocking the event loop.
+
+        :param control: AD7991Control
+        :param executor: executor for the blocking calls, None for get_executor()
+        """
+        self.control = control
+        self.executor = executor if executor is not None else get_executor()
+
+    @classmethod
+    async def create(cls, address=0x28, bus=1, backend=None, executor=None):
+        """
+        Open an AD7991 and write its initial config, see AD7991Control.
+
+        :rtype: AsyncAD7991Control
+        """
+        if executor is None:
+            executor = get_executor()
+        loop = asyncio.get_running_loop()
+        control = await loop.run_in_executor(executor, functools.partial(AD7991Control, address, bus, backend))
+        return cls(control, executor)
+
+    async def _run(self, function, *args, **kwargs):
+        return await _run_serialized(self.control.bus_manager, self.executor, function, *args, **kwargs)
+
+    async def read_all_channels(self):
+        """
+        :return: dict of channel: raw 12 bit ad result, see AD7991Control.read_all_channels
+        """
+        return await self._run(self.control.read_all_channels)
+
+    async def read_ad_result(self):
+        return await self._run(self.control.read_ad_result)
+
+    async def write_config(self, config):
+        await self._run(self.control.write_config, config)
+
+    async def configure(self, **kwargs):
+        """
+        Set several configuration fields with at most one write, see AD7991Control.configure.
+        """
+        await self._run(self.control.configure, **kwargs)
+
+    async def close(self):
+        await self._run(self.control.close)
+
+    async def scans(self, sample_rate, count=None):
+        """
+        Async iterator of timestamped scans at sample_rate scans per second.
+        Scans are scheduled on absolute deadlines of the event loop clock. If a
+        scan is late, the missed deadlines are skipped.
+
+        :param sample_rate: scans per second
+        :param count: number of scans, None to run until the iterator is closed
+        :return: async iterator of (timestamp, data) with data as from read_all_channels
+        """
+        if sample_rate <= 0:
+            raise ValueError('Sample rate must be positive')
+        loop = asyncio.get_running_loop()
+        period = 1.0 / sample_rate
+        deadline = loop.time()
+        n = 0
+        while count is None or n < count:
+            data = await self.read_all_channels()
+            yield time.time(), data
+            n += 1
+            deadline += period
+            now = loop.time()
+            if now > deadline:
+                deadline += period * (int((now - deadline) / period) + 1)
+            await asyncio.sleep(deadline - now)
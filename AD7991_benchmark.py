@@ -0,0 +1,224 @@
+"""Created on 18 oct 2026
+
+Throughput benchmarks for AD7991Control and the acquisition loop, run
+against the simulated AD7991 in i2c_sim so no hardware is needed.
+
+    python AD7991_benchmark.py --duration 2 --byte-time 22.5e-6
+
+Paths measured:
+    read:   one read_ad_result per enabled channel, the original onHandler scan
+    scan:   one read_all_channels per scan
+    loop:   AcquisitionThread scanning into a ScanRingBuffer at --rate
+    rr:     --devices controllers on one bus, scanned round-robin with I2CBusManager.scan_next
+    bus:    --devices controllers on one bus, scanned in one ioctl with I2CBusManager.scan
+
+@author: Filip Lindau
+"""
+import argparse
+import time
+import numpy as np
+
+from i2c_sim import SimulatedAD7991Backend
+from AD7991_control import AD7991Control
+from AD7991_acquisition import AcquisitionThread
+from AD7991_clock import monotonic
+from AD7991_buffer import ScanRingBuffer
+
+
+class BenchmarkResult(object):
+    def __init__(self, name, n_channels, latencies, elapsed, syscalls, errors=0):
+        """
+        Result of one benchmark run.
+
+        :param name: name of the measured path
+        :param n_channels: enabled channels, samples per scan
+        :param latencies: duration of each scan in seconds
+        :param elapsed: wall time of the run in seconds
+        :param syscalls: number of open, ioctl and close calls during the run
+        :param errors: number of failed scans, not included in latencies
+        """
+        self.name = name
+        self.scans = len(latencies)
+        self.samples = self.scans * n_channels
+        self.latencies = np.array(latencies)
+        self.elapsed = elapsed
+        self.syscalls = syscalls
+        self.errors = errors
+        self.overruns = None
+
+    def samples_per_second(self):
+        return self.samples / self.elapsed
+
+    def percentile_us(self, q):
+        if self.scans == 0:
+            return float('nan')
+        return np.percentile(self.latencies, q) * 1e6
+
+    def syscalls_per_sample(self):
+        if self.samples == 0:
+            return float('nan')
+        return float(self.syscalls) / self.samples
+
+    def __str__(self):
+        return '%-6s %10d %12.0f %10.1f %10.1f %10.1f %10.2f' % (self.name, self.scans, self.samples_per_second(),
+                                                               self.percentile_us(50), self.percentile_us(90),
+                                                               self.percentile_us(99), self.syscalls_per_sample())
+
+
+def bench_read(ad7991, backend, duration):
+    n_channels = sum(ad7991.channel_enable)
+    latencies = []
+    errors = 0
+    backend.reset_counters()
+    t_start = monotonic()
+    t_end = t_start + duration
+    t = t_start
+    while t < t_end:
+        try:
+            for ch in range(n_channels):
+                ad7991.read_ad_result()
+        except IOError:
+            errors += 1
+        else:
+            latencies.append(monotonic() - t)
+        t = monotonic()
+    return BenchmarkResult('read', n_channels, latencies, t - t_start, backend.syscalls, errors)
+
+
+def bench_scan(ad7991, backend, duration):
+    n_channels = sum(ad7991.channel_enable)
+    latencies = []
+    errors = 0
+    backend.reset_counters()
+    t_start = monotonic()
+    t_end = t_start + duration
+    t = t_start
+    while t < t_end:
+        try:
+            ad7991.read_all_channels()
+        except IOError:
+            errors += 1
+        else:
+            latencies.append(monotonic() - t)
+        t = monotonic()
+    return BenchmarkResult('scan', n_channels, latencies, t - t_start, backend.syscalls, errors)
+
+
+def bench_loop(ad7991, backend, duration, rate):
+    n_channels = sum(ad7991.channel_enable)
+    latencies = []
+    scan_buffer = ScanRingBuffer(10000)
+
+    def scan():
+        t = monotonic()
+        data = ad7991.read_all_channels()
+        latencies.append(monotonic() - t)
+        return data
+
+    def store(timestamp, data):
+        scan_buffer.append(timestamp, (data.get(0, 0), data.get(1, 0), data.get(2, 0), data.get(3, 0)))
+
+    acquisition = AcquisitionThread(scan, store, sample_rate=rate)
+    acquisition.start()
+    backend.reset_counters()
+    t_start = monotonic()
+    acquisition.resume()
+    time.sleep(duration)
+    acquisition.stop()
+    elapsed = monotonic() - t_start
+    result = BenchmarkResult('loop', n_channels, latencies, elapsed, backend.syscalls, backend.errors)
+    result.overruns = acquisition.overruns
+    return result
+
+
+def bench_round_robin(controllers, backend, duration):
+    manager = controllers[0].bus_manager
+    n_channels = sum([sum(c.channel_enable) for c in controllers])
+    latencies = []
+    errors = 0
+    backend.reset_counters()
+    t_start = monotonic()
+    t_end = t_start + duration
+    t = t_start
+    while t < t_end:
+        try:
+            for c in controllers:
+                manager.scan_next()
+        except IOError:
+            errors += 1
+        else:
+            latencies.append(monotonic() - t)
+        t = monotonic()
+    return BenchmarkResult('rr', n_channels, latencies, t - t_start, backend.syscalls, errors)
+
+
+def bench_combined(controllers, backend, duration):
+    manager = controllers[0].bus_manager
+    n_channels = sum([sum(c.channel_enable) for c in controllers])
+    latencies = []
+    errors = 0
+    backend.reset_counters()
+    t_start = monotonic()
+    t_end = t_start + duration
+    t = t_start
+    while t < t_end:
+        results = manager.scan()
+        for result in results.values():
+            if isinstance(result, IOError):
+                errors += 1
+        latencies.append(monotonic() - t)
+        t = monotonic()
+    return BenchmarkResult('bus', n_channels, latencies, t - t_start, backend.syscalls, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AD7991 read paths on a simulated bus')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per benchmark')
+    parser.add_argument('--channels', type=int, default=4, help='number of enabled channels, 1-4')
+    parser.add_argument('--rate', type=float, default=1000.0, help='acquisition loop scan rate in Hz')
+    parser.add_argument('--devices', type=int, default=8, help='number of devices on the bus for rr and bus')
+    parser.add_argument('--bus-latency', type=float, default=0.0, help='simulated time per transfer in s')
+    parser.add_argument('--byte-time', type=float, default=0.0, help='simulated time per byte in s')
+    parser.add_argument('--conversion-time', type=float, default=0.0, help='simulated time per conversion in s')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a failed transfer')
+    parser.add_argument('paths', nargs='*', default=['read', 'scan', 'loop'], help='paths to run')
+    args = parser.parse_args()
+
+    backend = SimulatedAD7991Backend(bus_latency=args.bus_latency, byte_time=args.byte_time,
+                                     conversion_time=args.conversion_time)
+    backend.error_rate = args.error_rate
+    ad7991 = AD7991Control(0x28, 1, backend=backend)
+    channels = [1 if ch < args.channels else 0 for ch in range(4)]
+    ad7991.configure(channels=channels)
+    controllers = [ad7991]
+    if 'rr' in args.paths or 'bus' in args.paths:
+        for address in range(0x29, 0x28 + args.devices):
+            controllers.append(AD7991Control(address, 1, backend=backend))
+            controllers[-1].configure(channels=channels)
+
+    print('%-6s %10s %12s %10s %10s %10s %10s' % ('path', 'scans', 'samples/s', 'p50 us', 'p90 us', 'p99 us',
+                                                  'sys/sample'))
+    for path in args.paths:
+        if path == 'read':
+            result = bench_read(ad7991, backend, args.duration)
+        elif path == 'scan':
+            result = bench_scan(ad7991, backend, args.duration)
+        elif path == 'loop':
+            result = bench_loop(ad7991, backend, args.duration, args.rate)
+        elif path == 'rr':
+            result = bench_round_robin(controllers, backend, args.duration)
+        elif path == 'bus':
+            result = bench_combined(controllers, backend, args.duration)
+        else:
+            parser.error(''.join(('Unknown path ', path)))
+        print(str(result))
+        if result.overruns is not None:
+            print(''.join(('       overruns: ', str(result.overruns))))
+        if result.errors > 0:
+            print(''.join(('       errors: ', str(result.errors))))
+    for c in controllers:
+        c.close()
+
+
+if __name__ == '__main__':
+    main()
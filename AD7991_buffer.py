@@ -0,0 +1,143 @@
+"""Created on 18 oct 2026
+
+Sample buffers for the AD7991 acquisition.
+
+@author: Filip Lindau
+"""
+import threading
+import collections
+import numpy as np
+
+
+class ScanRingBuffer(object):
+    def __init__(self, depth, n_channels=4):
+        """
+        Preallocated ring buffer of timestamped raw ad scans. Appending
+        overwrites the oldest scan once the buffer is full. The buffer can be
+        filled from one thread while being read from others.
+
+        :param depth: number of scans kept
+        :param n_channels: number of channels in each scan
+        """
+        if depth < 1:
+            raise ValueError('Buffer depth must be at least 1')
+        self.depth = int(depth)
+        self.n_channels = n_channels
+        self.timestamps = np.zeros(self.depth, dtype=np.float64)
+        self.raw = np.zeros((self.depth, n_channels), dtype=np.uint16)
+        self.index = 0      # Position of the next scan to write
+        self.count = 0      # Number of valid scans in the buffer
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, raw):
+        """
+        Add one scan.
+
+        :param timestamp: time of the scan, seconds since epoch
+        :param raw: sequence of n_channels raw ad results
+        """
+        with self.lock:
+            self.timestamps[self.index] = timestamp
+            self.raw[self.index, :] = raw
+            self.index += 1
+            if self.index == self.depth:
+                self.index = 0
+            if self.count < self.depth:
+                self.count += 1
+
+    def clear(self):
+        with self.lock:
+            self.index = 0
+            self.count = 0
+
+    def _ordered(self, data):
+        # Copy out the valid part of data in chronological order. Call with lock held.
+        if self.count < self.depth:
+            return data[:self.count].copy()
+        return np.concatenate((data[self.index:], data[:self.index]))
+
+    def get_timestamps(self):
+        """
+        :return: timestamps of the buffered scans, oldest first
+        """
+        with self.lock:
+            return self._ordered(self.timestamps)
+
+    def get_channel(self, channel):
+        """
+        :param channel: channel number
+        :return: raw results of channel for the buffered scans, oldest first
+        """
+        with self.lock:
+            return self._ordered(self.raw[:, channel])
+
+    def get(self):
+        """
+        :return: tuple of timestamps and (scans, n_channels) raw result array, oldest first
+        """
+        with self.lock:
+            return self._ordered(self.timestamps), self._ordered(self.raw)
+
+    def get_last(self, n):
+        """
+        Copy out only the newest scans.
+
+        :param n: max number of scans
+        :return: tuple of timestamps and (scans, n_channels) raw result array of the
+            newest min(n, count) scans, oldest first
+        """
+        with self.lock:
+            n = min(int(n), self.count)
+            start = self.index - n
+            if start >= 0:
+                return self.timestamps[start:self.index].copy(), self.raw[start:self.index].copy()
+            return (np.concatenate((self.timestamps[start:], self.timestamps[:self.index])),
+                    np.concatenate((self.raw[start:], self.raw[:self.index])))
+
+
+# Per-channel statistics of a block of scans, each field an array with one value per channel
+BlockStatistics = collections.namedtuple('BlockStatistics', ['timestamp', 'mean', 'std', 'min', 'max'])
+
+
+class BlockAccumulator(object):
+    def __init__(self, block_size, n_channels=4):
+        """
+        Collects raw scans into a preallocated block and computes per-channel
+        statistics when the block is full. Used for oversampling: one result is
+        published for every block_size scans. The block can be converted through
+        a calibration table before the statistics are computed.
+
+        :param block_size: number of scans per block
+        :param n_channels: number of channels in each scan
+        """
+        if block_size < 1:
+            raise ValueError('Block size must be at least 1')
+        self.block_size = int(block_size)
+        self.block = np.zeros((self.block_size, n_channels), dtype=np.uint16)
+        self.index = 0
+
+    def add(self, timestamp, raw, table=None):
+        """
+        Add one scan to the block.
+
+        :param timestamp: time of the scan
+        :param raw: sequence of n_channels raw ad results
+        :param table: AD7991_calibration.CalibrationTable converting the block to
+            volts when it is complete, None for statistics in raw units
+        :return: BlockStatistics when the scan completed the block, else None.
+            The timestamp is the time of the last scan in the block.
+        """
+        self.block[self.index, :] = raw
+        self.index += 1
+        if self.index < self.block_size:
+            return None
+        self.index = 0
+        if table is not None:
+            block = table.convert(self.block)
+        else:
+            block = self.block.astype(np.float64)
+        return BlockStatistics(timestamp, block.mean(axis=0), block.std(axis=0),
+                               block.min(axis=0), block.max(axis=0))
+
+    def reset(self):
+        self.index = 0
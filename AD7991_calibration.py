@@ -0,0 +1,129 @@
+"""Created on 18 oct 2026
+
+Per-channel calibration of AD7991 results, compiled into lookup tables.
+
+Each channel has a polynomial in the nominal voltage v = raw / 4095 * vref:
+
+    v_calibrated = c0 + c1 * v + c2 * v**2 + ...
+
+so [0, 1] is no correction, [offset, gain] a linear one, and higher orders
+correct nonlinearity. The polynomials are evaluated once for all 4096 raw
+codes into a (4, 4096) table, and converting any number of raw results is
+then a single NumPy index operation.
+
+@author: Filip Lindau
+"""
+import numpy as np
+
+N_CODES = 4096
+N_CHANNELS = 4
+
+
+def parse_calibration(lines):
+    """
+    Parse calibration polynomials from device property lines of the form
+    "<channel>: c0, c1, c2, ...". Channels without a line get [0, 1].
+
+    :param lines: sequence of strings
+    :return: list of N_CHANNELS coefficient lists
+    """
+    coefficients = [[0.0, 1.0] for ch in range(N_CHANNELS)]
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            channel, values = line.split(':', 1)
+            channel = int(channel)
+            values = [float(v) for v in values.replace(',', ' ').split()]
+        except ValueError:
+            raise ValueError(''.join(('Invalid calibration line "', line, '", should be "<channel>: c0, c1, ..."')))
+        if not 0 <= channel < N_CHANNELS:
+            raise ValueError(''.join(('Invalid calibration channel ', str(channel), ', must be 0..3')))
+        if len(values) == 0:
+            raise ValueError(''.join(('No coefficients for calibration channel ', str(channel))))
+        coefficients[channel] = values
+    return coefficients
+
+
+class CalibrationTable(object):
+    def __init__(self, vref, coefficients=None):
+        """
+        Raw to volts lookup table for all channels with one voltage reference.
+
+        :param vref: reference voltage in volts
+        :param coefficients: list of N_CHANNELS polynomial coefficient lists, lowest order first.
+            None for no correction.
+        """
+        self.vref = vref
+        if coefficients is None:
+            coefficients = [[0.0, 1.0] for ch in range(N_CHANNELS)]
+        self.coefficients = [list(c) for c in coefficients]
+        nominal = np.arange(N_CODES, dtype=np.float64) * (vref / (N_CODES - 1))
+        self.lut = np.empty((N_CHANNELS, N_CODES), dtype=np.float64)
+        for ch in range(N_CHANNELS):
+            # np.polyval wants the highest order first
+            self.lut[ch, :] = np.polyval(self.coefficients[ch][::-1], nominal)
+        self._channel_index = np.arange(N_CHANNELS)
+
+    def convert(self, raw):
+        """
+        Convert an array of raw scans to volts.
+
+        :param raw: integer array of shape (..., N_CHANNELS)
+        :return: float array of the same shape
+        """
+        return self.lut[self._channel_index, np.asarray(raw)]
+
+    def convert_channel(self, channel, raw):
+        """
+        Convert raw results of one channel to volts.
+
+        :param channel: channel number
+        :param raw: integer array of raw results
+        :return: float array of the same shape
+        """
+        return self.lut[channel][np.asarray(raw)]
+
+    def convert_scan(self, raw):
+        """
+        Convert one scan to volts.
+
+        :param raw: sequence of N_CHANNELS raw results
+        :return: tuple of N_CHANNELS floats
+        """
+        return tuple(self.lut[self._channel_index, raw].tolist())
+
+
+class Calibration(object):
+    def __init__(self, vrefs, coefficients=None):
+        """
+        Calibration tables for the reference modes of the AD7991. A table is
+        compiled the first time its reference mode is used and kept until the
+        reference voltage or coefficients of that mode change.
+
+        :param vrefs: dict of reference mode: reference voltage, e.g. {'vcc': 3.3, 'ext': 2.0}
+        :param coefficients: dict of reference mode: coefficient lists as from parse_calibration
+        """
+        self.vrefs = dict(vrefs)
+        self.coefficients = dict(coefficients) if coefficients is not None else {}
+        self._tables = {}
+
+    def set_coefficients(self, mode, coefficients):
+        self.coefficients[mode] = coefficients
+        self._tables.pop(mode, None)
+
+    def set_vref(self, mode, vref):
+        self.vrefs[mode] = vref
+        self._tables.pop(mode, None)
+
+    def get_table(self, mode):
+        """
+        :param mode: reference mode
+        :rtype: CalibrationTable
+        """
+        table = self._tables.get(mode)
+        if table is None:
+            table = CalibrationTable(self.vrefs[mode], self.coefficients.get(mode))
+            self._tables[mode] = table
+        return table
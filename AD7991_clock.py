@@ -0,0 +1,52 @@
+"""Created on 18 oct 2026
+
+Monotonic clock for scheduling and timing the AD7991 acquisition and i2c path.
+
+python 2 has no time.monotonic, so CLOCK_MONOTONIC is read with clock_gettime
+through ctypes there. The clock never steps with NTP or settimeofday, so
+deadlines and measured durations are not disturbed by wall clock changes.
+
+@author: Filip Lindau
+"""
+import ctypes
+import ctypes.util
+import os
+import time
+
+# From <linux/time.h>
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    for name in [ctypes.util.find_library('rt'), ctypes.util.find_library('c')]:
+        if name is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        clock_gettime.restype = ctypes.c_int
+        return clock_gettime
+    raise ImportError('clock_gettime not found, a monotonic clock is needed')
+
+
+if hasattr(time, 'monotonic'):
+    # CLOCK_MONOTONIC on linux
+    monotonic = time.monotonic
+else:
+    _clock_gettime = _load_clock_gettime()
+
+    def monotonic():
+        """
+        :return: seconds of CLOCK_MONOTONIC, from an arbitrary start
+        """
+        ts = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
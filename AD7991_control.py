@@ -1,9 +1,11 @@
 import time
 import logging
 import struct
+import threading
+import contextlib
 import numpy as np
 
-from i2c_per import I2C
+from i2c_per import I2C, I2CError, I2CStatistics, RetryPolicy, get_default_backend
 
 logger = logging.getLogger()
 f = logging.Formatter("%(asctime)s - %(module)s.   %(funcName)s - %(levelname)s - %(message)s")
@@ -12,24 +14,314 @@ fh.setFormatter(f)
 logger.addHandler(fh)
 logger.setLevel(logging.CRITICAL)
 
+# Bus managers, one per bus device path and backend, shared by all controllers on that bus
+_bus_managers = {}
+_bus_managers_lock = threading.Lock()
+
+
+class ScanResult(dict):
+    """
+    dict of channel: raw 12 bit ad result of one scan, with the config byte the
+    device had during the read in config. config is None if a config write was
+    in progress, then it is not known which config the results are for.
+    """
+    __slots__ = ['config']
+
+    def __init__(self, config=None):
+        dict.__init__(self)
+        self.config = config
+
+    @property
+    def ref_sel(self):
+        """
+        :return: REF_SEL during the read, 0 for vcc and 1 for external reference, None if unknown
+        """
+        if self.config is None:
+            return None
+        return (self.config >> 3) & 1
+
+
+class I2CBusManager(object):
+    # Max number of messages in one I2C_RDWR ioctl
+    max_messages = I2C._I2C_RDWR_IOCTL_MAX_MSGS
+
+    def __init__(self, bus_name, backend):
+        """
+        Owns the i2c-dev handle of one bus and serializes all transactions on it.
+        The AD7991Control instances on the bus register here and can be scanned
+        together, either one device at a time round-robin (scan_next) or all
+        in one I2C_RDWR ioctl with one message per device (scan).
+
+        Obtain instances through acquire_bus and give them back with release_bus.
+
+        :param bus_name: i2c-dev device path, e.g. /dev/i2c-1
+        :param backend: i2c_per backend doing the system calls
+        """
+        self.bus_name = bus_name
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.users = 0
+        self.controllers = []
+        # Kept over reopen
+        self.statistics = I2CStatistics()
+        self.i2c = I2C(bus_name, backend, self.statistics)
+        self._next_controller = 0
+        self._scan_key = None
+        self._scan_transfers = []
+
+    def transfer(self, address, messages):
+        with self.lock:
+            self.i2c.transfer(address, messages)
+
+    def transfer_prepared(self, prepared):
+        with self.lock:
+            self.i2c.transfer_prepared(prepared)
+
+    def reopen(self):
+        """
+        Close and open the underlying i2c-dev file. Used to recover from a bad
+        file descriptor. All controllers on the bus see the new descriptor.
+        """
+        with self.lock:
+            try:
+                self.i2c.close()
+            except I2CError as e:
+                logger.warning(''.join(('Error closing ', self.bus_name, ', ', str(e))))
+            self.i2c = I2C(self.bus_name, self.backend, self.statistics)
+
+    def register(self, controller):
+        with self.lock:
+            if controller not in self.controllers:
+                self.controllers.append(controller)
+
+    def unregister(self, controller):
+        with self.lock:
+            if controller in self.controllers:
+                self.controllers.remove(controller)
+
+    def scan_next(self):
+        """
+        Scan the next registered controller, cycling through them round-robin.
+
+        :return: tuple of controller and its read_all_channels result, or None if
+            no controller is registered
+        """
+        with self.lock:
+            if len(self.controllers) == 0:
+                return None
+            self._next_controller %= len(self.controllers)
+            controller = self.controllers[self._next_controller]
+            self._next_controller += 1
+        return controller, controller.read_all_channels()
+
+    def scan(self, controllers=None):
+        """
+        Read all enabled channels of several controllers in one I2C_RDWR ioctl,
+        one read message per device (split in several ioctls above max_messages).
+        If the combined transfer fails, the devices are read one by one so that
+        only the failing devices are affected.
+
+        :param controllers: controllers to scan, default all registered
+        :return: dict of address: result, where result is the channel: raw ad dict
+            from read_all_channels, or the IOError raised for that device
+        """
+        with self.lock:
+            if controllers is None:
+                controllers = list(self.controllers)
+            active = [c for c in controllers if sum(c.channel_enable) > 0]
+            results = dict([(c.addr, {}) for c in controllers if c not in active])
+            if len(active) == 0:
+                return results
+            key = tuple([(c.addr, sum(c.channel_enable)) for c in active])
+            if key != self._scan_key:
+                self._scan_transfers = self._prepare_scan(active)
+                self._scan_key = key
+            try:
+                for prepared, chunk in self._scan_transfers:
+                    snapshots = [c.config_snapshot() for c in chunk]
+                    self.i2c.transfer_prepared(prepared)
+                    for i, c in enumerate(chunk):
+                        results[c.addr] = c.decode_scan(prepared.buffers[i], sum(c.channel_enable),
+                                                        c.config_after(snapshots[i]))
+                return results
+            except IOError as e:
+                logger.warning(''.join(('Combined scan on ', self.bus_name, ' failed, ', str(e),
+                                        ', reading devices separately')))
+        for c in active:
+            try:
+                results[c.addr] = c.read_all_channels()
+            except IOError as e:
+                results[c.addr] = e
+        return results
+
+    def _prepare_scan(self, controllers):
+        transfers = []
+        for i in range(0, len(controllers), self.max_messages):
+            chunk = controllers[i:i + self.max_messages]
+            messages = [I2C.Message(bytearray(2 * sum(c.channel_enable)), read=True, flags=0, addr=c.addr)
+                        for c in chunk]
+            transfers.append((I2C.PreparedTransfer(chunk[0].addr, messages), chunk))
+        return transfers
+
+
+def acquire_bus(bus_name, backend=None):
+    """
+    Get the bus manager for bus_name, opening the device if no other
+    controller is using it.
+
+    :param bus_name: i2c-dev device path
+    :param backend: i2c_per backend, None for the default backend
+    :return: I2CBusManager
+    """
+    if backend is None:
+        backend = get_default_backend()
+    with _bus_managers_lock:
+        manager = _bus_managers.get((bus_name, backend))
+        if manager is None:
+            manager = I2CBusManager(bus_name, backend)
+            _bus_managers[(bus_name, backend)] = manager
+        manager.users += 1
+        return manager
+
+
+def release_bus(manager):
+    """
+    Give back a bus manager obtained from acquire_bus. The device file is closed
+    when the last user releases it.
+
+    :param manager: I2CBusManager
+    """
+    with _bus_managers_lock:
+        manager.users -= 1
+        if manager.users > 0:
+            return
+        if _bus_managers.get((manager.bus_name, manager.backend)) is manager:
+            del _bus_managers[(manager.bus_name, manager.backend)]
+    with manager.lock:
+        manager.i2c.close()
+
 
 class AD7991Control(object):
-    def __init__(self, address=0x28, bus=1):
+    def __init__(self, address=0x28, bus=1, backend=None, retry_policy=None):
         """
         Control of AD7991 thorugh i2c using the smbus package.
 
+        The i2c-dev device is opened once and kept open until close() is called.
+        Controllers on the same bus share the file descriptor through an
+        I2CBusManager, which serializes their transactions.
+
+        Transfers failing with a transient error are retried according to
+        retry_policy, releasing the bus between attempts. Only when the policy
+        gives up is the IOError raised.
+
         :param address: i2c address of the device (default 0x28 for AD7991)
         :param bus: i2c bus connected (bus 1 for the raspberry)
+        :param backend: i2c_per backend doing the system calls, None for the default
+            i2c-dev backend. See i2c_sim for a simulated AD7991.
+        :param retry_policy: i2c_per.RetryPolicy, None for the default RetryPolicy().
+            RetryPolicy(0) disables retries.
         """
         self.bus_name = ''.join(('/dev/i2c-', str(bus)))
         self.addr = address
+        self.backend = backend
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.bus_manager = None
+        self.open()
 
         self.ref_sel = 0        # 0 = vcc as reference, 1 = external reference on vin3
         self.bit_trial_delay = 0
         self.sample_delay = 0
         self.fltr = 0
         self.channel_enable = [1, 0, 0, 0]
-        self.write_config(self.compile_config())
+        self.config = None      # Last config byte written to the device
+        # Config writes started and finished, to tell if a read overlapped a write
+        self._config_writes = 0
+        self._config_writes_done = 0
+        self._batch_depth = 0
+
+        # Transfers are built once and reused, see I2C.PreparedTransfer
+        self._config_transfer = I2C.PreparedTransfer(address, [I2C.Message(bytearray(1), read=False, flags=0)])
+        self._config_buffer = self._config_transfer.buffers[0]
+        self._read_transfers = {}
+        for n_channels in range(1, 5):
+            prepared = I2C.PreparedTransfer(address, [I2C.Message(bytearray(2 * n_channels), read=True, flags=0)])
+            self._read_transfers[n_channels] = (prepared, struct.Struct(''.join(('>', str(n_channels), 'H'))))
+        try:
+            self.write_config(self.compile_config())
+        except IOError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Open the i2c-dev device, or share the bus manager if it is already open,
+        and register with the bus manager.
+        Does nothing if this controller is already open.
+        """
+        if self.bus_manager is None:
+            self.bus_manager = acquire_bus(self.bus_name, self.backend)
+            self.bus_manager.register(self)
+            logger.debug(''.join(('Opened ', self.bus_name)))
+
+    def close(self):
+        """
+        Unregister from the bus manager and release it. The device file is closed
+        when no other controller on the bus is using it.
+        """
+        if self.bus_manager is not None:
+            manager = self.bus_manager
+            self.bus_manager = None
+            manager.unregister(self)
+            release_bus(manager)
+            logger.debug(''.join(('Closed ', self.bus_name)))
+
+    def reopen(self):
+        """
+        Reopen the i2c-dev device after an error, keeping the bus manager.
+        """
+        if self.bus_manager is None:
+            self.open()
+        else:
+            self.bus_manager.reopen()
+            logger.debug(''.join(('Reopened ', self.bus_name)))
+
+    def _transfer(self, prepared):
+        manager = self.bus_manager
+        if manager is None:
+            raise I2CError(None, ''.join(('I2C device ', self.bus_name, ' not open')))
+        try:
+            manager.transfer_prepared(prepared)
+        except IOError as e:
+            self._retry_transfer(manager, prepared, e)
+
+    def _retry_transfer(self, manager, prepared, error):
+        # Retry a failed transfer according to retry_policy, raise when it gives up
+        policy = self.retry_policy
+        stats = manager.statistics
+        retry = 0
+        while retry < policy.max_retries and policy.is_transient(error.errno):
+            retry += 1
+            # Counted under the bus lock like the I2C counters, other threads share the bus
+            with manager.lock:
+                stats.retried_transfers += 1
+            delay = policy.retry_delay(retry)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                manager.transfer_prepared(prepared)
+                logger.debug(''.join(('Transfer to ', hex(self.addr), ' succeeded on retry ', str(retry))))
+                return
+            except IOError as e:
+                error = e
+        with manager.lock:
+            stats.failed_transfers += 1
+        raise error
 
     def compile_config(self):
         config = 0
@@ -43,40 +335,187 @@ class AD7991Control(object):
         config += self.channel_enable[3] << 7
         return config
 
+    def _apply_config(self, force=False):
+        """
+        Compile the config and write it if it differs from the config last
+        written. Deferred while a batch is open.
+        """
+        if self._batch_depth > 0:
+            return
+        config = self.compile_config()
+        if force is True or config != self.config:
+            self.write_config(config)
+        else:
+            logger.debug(''.join(('Config ', str(config), ' unchanged, not writing')))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager collecting several setter calls into one config write
+        when the outermost batch exits:
+
+            with ad7991.batch():
+                ad7991.set_reference('ext')
+                ad7991.set_channel_enable(3, 0)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        self._apply_config()
+
+    def configure(self, channels=None, reference=None, filter=None, bit_trial_delay=None, sample_delay=None,
+                  force=False):
+        """
+        Set several configuration fields at once. The config byte is compiled once
+        and written only if it differs from the config last written (or if force
+        is True). Parameters left as None keep their current value. If the write
+        fails the previous settings are restored.
+
+        :param channels: sequence of 4 channel enables
+        :param reference: 'internal' (or 'vcc') or 'external', see set_reference
+        :param filter: 1 to enable the i2c input filter
+        :param bit_trial_delay: 1 to enable bit trial delay
+        :param sample_delay: 1 to enable sample delay
+        :param force: write the config even if it is unchanged
+        """
+        if channels is not None:
+            if len(channels) != 4:
+                raise ValueError('Channels must be a sequence of 4 enables')
+            channel_enable = [1 if enable == 1 else 0 for enable in channels]
+        else:
+            channel_enable = list(self.channel_enable)
+        if reference is not None:
+            ref_sel = self._parse_reference(reference)
+        else:
+            ref_sel = self.ref_sel
+
+        old_settings = (self.channel_enable, self.ref_sel, self.fltr, self.bit_trial_delay, self.sample_delay)
+        self.channel_enable = channel_enable
+        self.ref_sel = ref_sel
+        if filter is not None:
+            self.fltr = 1 if filter == 1 else 0
+        if bit_trial_delay is not None:
+            self.bit_trial_delay = 1 if bit_trial_delay == 1 else 0
+        if sample_delay is not None:
+            self.sample_delay = 1 if sample_delay == 1 else 0
+        try:
+            self._apply_config(force)
+        except IOError:
+            self.channel_enable, self.ref_sel, self.fltr, self.bit_trial_delay, self.sample_delay = old_settings
+            raise
+
     def write_config(self, config):
+        self._config_writes += 1
         try:
-            data = [np.uint8(config)]
-            msg = [I2C.Message(data, read=False, flags=0)]
-            with I2C(self.bus_name) as i2c:
-                i2c.transfer(self.addr, msg)
+            self._config_buffer[0] = np.uint8(config)
+            self._transfer(self._config_transfer)
             logger.debug(''.join(('Writing config ', str(config))))
             self.config = config
-        except IOError, e:
+        except IOError as e:
             logger.error(''.join(('Error writing config, ', str(e))))
             raise
+        finally:
+            self._config_writes_done += 1
+
+    def config_snapshot(self):
+        """
+        Take before a read transfer, and pass to config_after when it is done.
+
+        :return: tuple of config writes started and the config, None if a write is in progress
+        """
+        writes = self._config_writes
+        if self._config_writes_done != writes:
+            return writes, None
+        return writes, self.config
+
+    def config_after(self, snapshot):
+        """
+        :param snapshot: config_snapshot() taken before the read transfer
+        :return: the config the device had during the read, None if a config
+            write may have overlapped it
+        """
+        writes, config = snapshot
+        if self._config_writes != writes:
+            return None
+        return config
 
     def read_ad_result(self):
         try:
-            msg = [I2C.Message(bytearray(2), read=True, flags=0)]
-            with I2C(self.bus_name) as i2c:
-                i2c.transfer(self.addr, msg)
-            data = struct.unpack('>h', msg[0].data)[0]
+            prepared, words = self._read_transfers[1]
+            self._transfer(prepared)
+            data = words.unpack_from(prepared.buffers[0])[0]
             # logger.debug(''.join(('Returned ', str(data), ' ', str(bin(data)))))
             ch = data >> 12     # Mask out channel bits
             ad = data & 0b0000111111111111  # Mask out first 12 bits
             return ch, ad
-        except IOError, e:
+        except IOError as e:
             logger.error(''.join(('Error reading ad, ', str(e))))
             raise
             # return False
 
+    def read_all_channels(self):
+        """
+        Read one conversion from each enabled channel in a single i2c transaction.
+        The AD7991 converts the enabled channels round-robin, returning two bytes
+        per conversion with the channel id in bits 12-13.
+
+        :return: ScanResult, dict of channel: raw 12 bit ad result
+        """
+        snapshot = self.config_snapshot()
+        n_channels = sum(self.channel_enable)
+        if n_channels == 0:
+            return ScanResult(self.config_after(snapshot))
+        try:
+            prepared, words = self._read_transfers[n_channels]
+            self._transfer(prepared)
+            return self.decode_scan(prepared.buffers[0], n_channels, self.config_after(snapshot))
+        except IOError as e:
+            logger.error(''.join(('Error reading ad channels, ', str(e))))
+            raise
+
+    def verify(self):
+        """
+        Check with one read that the device answers with the enabled channels.
+        If it answers with other channels, e.g. after a power cycle reset its
+        config register, the config is written again and the read repeated.
+
+        :return: True if the device answered with the enabled channels
+        """
+        enabled = set([ch for ch in range(4) if self.channel_enable[ch] == 1])
+        if len(enabled) == 0:
+            self.read_ad_result()
+            return True
+        for attempt in range(2):
+            if set(self.read_all_channels().keys()) == enabled:
+                return True
+            if attempt == 0:
+                logger.warning(''.join(('Unexpected channels from ', hex(self.addr), ', rewriting config')))
+                self._apply_config(force=True)
+        return False
+
+    def decode_scan(self, buffer, n_channels, config=None):
+        """
+        Decode n_channels conversion results read from the device.
+
+        :param buffer: bytearray of 2 * n_channels bytes
+        :param n_channels: number of conversions in buffer
+        :param config: config byte of the device during the read, None if unknown
+        :return: ScanResult, dict of channel: raw 12 bit ad result
+        """
+        result = ScanResult(config)
+        for data in self._read_transfers[n_channels][1].unpack_from(buffer):
+            result[(data >> 12) & 0b11] = data & 0b0000111111111111
+        return result
+
     def set_channel_enable(self, channel, enable):
         if 0 <= channel < 4:
             if enable == 1:
                 self.channel_enable[channel] = 1
             else:
                 self.channel_enable[channel] = 0
-            self.write_config(self.compile_config())
+            self._apply_config()
         else:
             raise ValueError(''.join(('Channel must be 0..3')))
 
@@ -87,14 +526,24 @@ class AD7991Control(object):
             ref = 'internal' or 'vcc'... use vcc (3.3V) as reference
             ref = 'external'... use external voltage reference on pin Vin3
         '''
+        self.ref_sel = self._parse_reference(ref)
+        self._apply_config()
+
+    def set_filter(self, enable):
+        ''' Enable or disable the filter on the SDA and SCL inputs.
+        '''
+        self.fltr = 1 if enable == 1 else 0
+        self._apply_config()
+
+    @staticmethod
+    def _parse_reference(ref):
         s = str(ref).lower()
         if s in ['internal', 'vcc', 'int']:
-            self.ref_sel = 0
+            return 0
         elif s in ['external', 'ext']:
-            self.ref_sel = 1
+            return 1
         else:
             raise ValueError('Ref must be internal (or vcc), or external')
-        self.write_config(self.compile_config())
 
 
 if __name__ == '__main__':
@@ -103,3 +552,4 @@ if __name__ == '__main__':
     logger.info(''.join(('External ref: ', str(ad7991.read_ad_result()))))
     ad7991.set_reference('internal')
     logger.info(''.join(('Internal ref: ', str(ad7991.read_ad_result()))))
+    ad7991.close()
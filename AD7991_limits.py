@@ -0,0 +1,164 @@
+"""Created on 18 oct 2026
+
+Per-channel alarm limits with hysteresis, checked on every AD7991 scan.
+
+A channel trips when it goes below its min or above its max limit, and clears
+when it is back inside by the hysteresis. Limits are given in volts and
+converted to raw codes once with the calibration table, so a check costs a
+few integer comparisons per channel.
+
+@author: Filip Lindau
+"""
+import collections
+import threading
+import numpy as np
+
+N_CHANNELS = 4
+
+# Limits of one channel in volts, min or max None when not limited
+ChannelLimit = collections.namedtuple('ChannelLimit', ['channel', 'min', 'max', 'hysteresis'])
+
+
+def parse_limits(lines):
+    """
+    Parse channel limits from device property lines of the form
+    "<channel>: <min>, <max>, <hysteresis>" in volts. min or max can be
+    "none" for no limit, and the hysteresis can be left out for 0.
+
+    :param lines: sequence of strings
+    :return: list of ChannelLimit
+    """
+    limits = []
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            channel, values = line.split(':', 1)
+            channel = int(channel)
+            values = [v.strip().lower() for v in values.split(',')]
+            if len(values) not in [2, 3]:
+                raise ValueError
+            low = None if values[0] == 'none' else float(values[0])
+            high = None if values[1] == 'none' else float(values[1])
+            hysteresis = float(values[2]) if len(values) == 3 else 0.0
+        except ValueError:
+            raise ValueError(''.join(('Invalid limit line "', line, '", should be "<channel>: <min>, <max>, <hysteresis>"')))
+        if not 0 <= channel < N_CHANNELS:
+            raise ValueError(''.join(('Invalid limit channel ', str(channel), ', must be 0..3')))
+        if low is not None and high is not None and low >= high:
+            raise ValueError(''.join(('Limit min must be below max for channel ', str(channel))))
+        if channel in [limit.channel for limit in limits]:
+            raise ValueError(''.join(('More than one limit line for channel ', str(channel))))
+        limits.append(ChannelLimit(channel, low, high, abs(hysteresis)))
+    return limits
+
+
+class LimitChecker(object):
+    def __init__(self, limits=None, table=None):
+        """
+        Checks scans against channel limits and keeps track of the tripped
+        channels. check is called from the acquisition thread, the other
+        methods may be called from any thread.
+
+        :param limits: list of ChannelLimit
+        :param table: AD7991_calibration.CalibrationTable used to convert the
+            limits to raw codes, must increase with the code
+        """
+        self.limits = []
+        self.lock = threading.Lock()
+        # channel: 'min' or 'max' for the tripped channels
+        self.tripped = {}
+        # (channel, min levels, max levels), levels (trip, clear) in raw codes or None
+        self._levels = []
+        if limits is not None:
+            self.set_limits(limits, table)
+
+    def set_limits(self, limits, table):
+        """
+        Set the limits and convert them to raw codes with table. Tripped
+        channels stay tripped if they still have a limit on the tripped side,
+        so they clear on a later scan.
+
+        :return: True if the tripped channels changed
+        """
+        levels = []
+        for limit in limits:
+            lut = table.lut[limit.channel]
+            low = None
+            high = None
+            if limit.min is not None:
+                # Trip on code < trip level, clear on code >= clear level
+                low = (int(np.searchsorted(lut, limit.min)), int(np.searchsorted(lut, limit.min + limit.hysteresis)))
+            if limit.max is not None:
+                # Trip on code >= trip level, clear on code < clear level
+                high = (int(np.searchsorted(lut, limit.max, 'right')),
+                        int(np.searchsorted(lut, limit.max - limit.hysteresis, 'right')))
+            if low is not None or high is not None:
+                levels.append((limit.channel, low, high))
+        sides = {}
+        for channel, low, high in levels:
+            sides[channel] = [side for side, level in [('min', low), ('max', high)] if level is not None]
+        with self.lock:
+            tripped = dict([(channel, side) for channel, side in self.tripped.items()
+                            if side in sides.get(channel, [])])
+            changed = tripped != self.tripped
+            self.limits = list(limits)
+            self._levels = levels
+            self.tripped = tripped
+        return changed
+
+    def reset(self):
+        """
+        Clear the tripped channels, they are evaluated again on the next scan.
+        """
+        with self.lock:
+            self.tripped = {}
+
+    def check(self, data):
+        """
+        Check one scan.
+
+        :param data: dict of channel: raw ad result, channels not in it are not checked
+        :return: True if the tripped channels changed
+        """
+        with self.lock:
+            return self._check(data)
+
+    def _check(self, data):
+        changed = False
+        tripped = self.tripped
+        for channel, low, high in self._levels:
+            value = data.get(channel)
+            if value is None:
+                continue
+            side = tripped.get(channel)
+            if (side == 'min' and value >= low[1]) or (side == 'max' and value < high[1]):
+                del tripped[channel]
+                changed = True
+                side = None
+            # Also right after clearing, so a jump from above max to below min trips in the same scan
+            if side is None:
+                if low is not None and value < low[0]:
+                    tripped[channel] = 'min'
+                    changed = True
+                elif high is not None and value >= high[0]:
+                    tripped[channel] = 'max'
+                    changed = True
+        return changed
+
+    def describe(self):
+        """
+        :return: string naming the tripped channels and their limits, empty if none
+        """
+        with self.lock:
+            limits = self.limits
+            tripped = dict(self.tripped)
+        descriptions = []
+        for limit in limits:
+            side = tripped.get(limit.channel)
+            if side == 'min' and limit.min is not None:
+                descriptions.append(''.join(('channel ', str(limit.channel), ' below min ', str(limit.min), ' V')))
+            elif side == 'max' and limit.max is not None:
+                descriptions.append(''.join(('channel ', str(limit.channel), ' above max ', str(limit.max), ' V')))
+        return ', '.join(descriptions)
@@ -0,0 +1,65 @@
+"""Created on 18 oct 2026
+
+Coalescing command mailbox for the AD7991DS state thread.
+
+Unlike a FIFO queue the mailbox keeps only the latest command of each name,
+so a burst of attribute writes is applied once with the final value, and
+posting never blocks the Tango request threads.
+
+@author: Filip Lindau
+"""
+import threading
+import time
+import collections
+
+
+class CommandMailbox(object):
+    def __init__(self):
+        """
+        Mailbox of pending commands, objects with a command attribute holding
+        the command name. A command replaces a pending command of the same
+        name and moves to the end of the pending order.
+        """
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self.posted = 0         # Commands posted
+        self.superseded = 0     # Commands replaced before they were taken
+
+    def put(self, cmd):
+        """
+        Post cmd, replacing a pending command with the same name. Never blocks
+        for longer than it takes to update the pending commands.
+
+        :param cmd: command object with a command attribute
+        """
+        with self._condition:
+            if cmd.command in self._pending:
+                del self._pending[cmd.command]
+                self.superseded += 1
+            self._pending[cmd.command] = cmd
+            self.posted += 1
+            self._condition.notify()
+
+    def get(self, timeout=0):
+        """
+        Take all pending commands. If there are none, wait up to timeout s for
+        one to be posted.
+
+        :param timeout: max wait in s, 0 to return immediately
+        :return: list of commands in the order they were last posted, empty if none
+        """
+        with self._condition:
+            if timeout > 0:
+                deadline = time.time() + timeout
+                while len(self._pending) == 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            commands = list(self._pending.values())
+            self._pending.clear()
+        return commands
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
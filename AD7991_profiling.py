@@ -0,0 +1,217 @@
+"""Created on 18 oct 2026
+
+On demand per stage timing of the AD7991 acquisition and i2c path.
+
+StageProfiler installs timing wrappers as instance attributes over the
+methods to measure, and restore() removes them again. Nothing is wrapped
+while profiling is off, so the normal code path is unchanged and costs
+nothing extra.
+
+    profiler = StageProfiler()
+    profiler.wrap_controller(ad7991)
+    profiler.wrap(acquisition, 'scan_function', 'scan')
+    ...
+    profiler.restore()
+    print(profiler.report_json())
+
+@author: Filip Lindau
+"""
+import threading
+import time
+import json
+import cProfile
+import numpy as np
+
+from AD7991_clock import monotonic
+
+
+class _TimedLock(object):
+    def __init__(self, lock, samples):
+        # Proxy of a lock recording the time spent waiting in acquire
+        self.lock = lock
+        self.samples = samples
+
+    def acquire(self, *args):
+        t_start = monotonic()
+        result = self.lock.acquire(*args)
+        self.samples.append(monotonic() - t_start)
+        return result
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.lock.release()
+
+
+class _TimedBackend(object):
+    def __init__(self, backend, samples, local):
+        # Proxy of an i2c_per backend recording the duration of each ioctl
+        self.backend = backend
+        self.samples = samples
+        self.local = local
+
+    def open(self, devpath):
+        return self.backend.open(devpath)
+
+    def ioctl(self, fd, request, arg, mutate_flag):
+        t_start = monotonic()
+        try:
+            return self.backend.ioctl(fd, request, arg, mutate_flag)
+        finally:
+            duration = monotonic() - t_start
+            self.samples.append(duration)
+            self.local.ioctl_time = getattr(self.local, 'ioctl_time', 0.0) + duration
+
+    def close(self, fd):
+        self.backend.close(fd)
+
+
+class StageProfiler(object):
+    def __init__(self, use_cprofile=False):
+        """
+        Collects the duration of every call of the wrapped methods, grouped by
+        stage name. Stages of the i2c path:
+
+            lock wait:  waiting for the bus lock of the I2CBusManager
+            marshal:    I2C transfer call excluding the ioctl, i.e. ctypes conversion
+            ioctl:      the I2C_RDWR system call
+            decode:     unpacking the read buffer into channel results
+
+        The bus stages include the transfers of every controller on the bus.
+
+        :param use_cprofile: also run cProfile over the methods wrapped with
+            cprofile=True, see dump_stats
+        """
+        self.samples = {}
+        self.start_time = None
+        self.stop_time = None
+        self.cprofile = cProfile.Profile() if use_cprofile is True else None
+        self._patches = []
+        self._local = threading.local()
+
+    def _stage_samples(self, stage):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = []
+            self.samples[stage] = samples
+        return samples
+
+    def _patch(self, obj, name, value):
+        had_instance_attr = name in getattr(obj, '__dict__', {})
+        self._patches.append((obj, name, had_instance_attr, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def start(self):
+        self.start_time = time.time()
+
+    def wrap(self, obj, name, stage, cprofile=False):
+        """
+        Time each call of obj.name as stage.
+
+        :param obj: object with the method or function attribute to time
+        :param name: attribute name
+        :param stage: name of the stage in the report
+        :param cprofile: run cProfile during the calls, if enabled. Only for
+            methods called from one thread.
+        """
+        original = getattr(obj, name)
+        samples = self._stage_samples(stage)
+        profile = self.cprofile if cprofile is True else None
+
+        def timed(*args, **kwargs):
+            if profile is not None:
+                profile.enable()
+            t_start = monotonic()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(monotonic() - t_start)
+                if profile is not None:
+                    profile.disable()
+        self._patch(obj, name, timed)
+
+    def wrap_lock(self, obj, name, stage):
+        """
+        Time the waits to acquire the lock obj.name as stage.
+        """
+        self._patch(obj, name, _TimedLock(getattr(obj, name), self._stage_samples(stage)))
+
+    def wrap_i2c(self, i2c):
+        """
+        Time the ioctl and marshal stages of an i2c_per.I2C.
+        """
+        self._patch(i2c, '_backend', _TimedBackend(i2c.backend, self._stage_samples('ioctl'), self._local))
+        self._wrap_marshal(i2c, 'transfer')
+        self._wrap_marshal(i2c, 'transfer_prepared')
+
+    def _wrap_marshal(self, i2c, name):
+        # The ioctl proxy adds its time to local.ioctl_time, the rest of the call is marshalling
+        original = getattr(i2c, name)
+        samples = self._stage_samples('marshal')
+        local = self._local
+
+        def timed(*args, **kwargs):
+            local.ioctl_time = 0.0
+            t_start = monotonic()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(monotonic() - t_start - local.ioctl_time)
+        self._patch(i2c, name, timed)
+
+    def wrap_controller(self, controller):
+        """
+        Time the bus lock, i2c and decode stages of an open AD7991Control.
+        """
+        manager = controller.bus_manager
+        self.wrap_lock(manager, 'lock', 'lock wait')
+        self.wrap_i2c(manager.i2c)
+        self.wrap(controller, 'decode_scan', 'decode')
+
+    def restore(self):
+        """
+        Remove all wrappers, in reverse order of installation.
+        """
+        while len(self._patches) > 0:
+            obj, name, had_instance_attr, original = self._patches.pop()
+            if had_instance_attr is True:
+                setattr(obj, name, original)
+            else:
+                delattr(obj, name)
+        if self.stop_time is None:
+            self.stop_time = time.time()
+
+    def report(self):
+        """
+        :return: dict of stage: dict of count, total, mean, p50 and p99 in seconds
+        """
+        result = {}
+        for stage, samples in self.samples.items():
+            durations = np.array(samples)
+            if durations.size == 0:
+                result[stage] = {'count': 0, 'total': 0.0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0}
+                continue
+            result[stage] = {'count': int(durations.size),
+                             'total': float(durations.sum()),
+                             'mean': float(durations.mean()),
+                             'p50': float(np.percentile(durations, 50)),
+                             'p99': float(np.percentile(durations, 99))}
+        return result
+
+    def report_json(self):
+        stop_time = self.stop_time if self.stop_time is not None else time.time()
+        return json.dumps({'start': self.start_time,
+                           'duration': stop_time - self.start_time if self.start_time is not None else 0.0,
+                           'stages': self.report()}, sort_keys=True)
+
+    def dump_stats(self, filename):
+        """
+        Write the cProfile statistics to filename, for pstats.
+        """
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(filename)
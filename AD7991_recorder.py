@@ -0,0 +1,189 @@
+"""Created on 18 oct 2026
+
+Streaming recorder of timestamped raw AD7991 scans to binary files.
+
+File format: a 16 byte header, the magic b'AD7991R1' followed by the
+little endian uint32 record size and channel count, then fixed size
+records of a float64 timestamp (seconds since epoch) and one uint16 raw
+result per channel, all little endian. read_recording loads a file into
+NumPy arrays.
+
+Scans are collected into preallocated record blocks in the acquisition
+thread and handed to a writer thread through a bounded queue, so writing
+never blocks the acquisition. If the queue is full the block is dropped
+and counted. Files are rotated by size and age.
+
+@author: Filip Lindau
+"""
+import os
+import struct
+import threading
+import time
+import logging
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AD7991R1'
+N_CHANNELS = 4
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('raw', '<u2', (N_CHANNELS,))])
+_HEADER = struct.Struct('<8sII')
+
+
+def read_recording(filename):
+    """
+    Read a recording file.
+
+    :param filename: file written by Recorder
+    :return: tuple of timestamps array and (records, channels) raw result array
+    """
+    with open(filename, 'rb') as f:
+        magic, record_size, n_channels = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or record_size != RECORD_DTYPE.itemsize or n_channels != N_CHANNELS:
+            raise ValueError(''.join(('Not an AD7991 recording: ', filename)))
+        records = np.fromfile(f, dtype=RECORD_DTYPE)
+    return records['timestamp'], records['raw']
+
+
+class Recorder(object):
+    def __init__(self, directory, prefix='ad7991', block_size=1024, queue_size=16, max_file_size=100e6,
+                 max_file_age=3600.0):
+        """
+        Record timestamped raw scans to files in directory, named
+        <prefix>_<date>_<time>.ad7991.
+
+        :param directory: directory of the recording files
+        :param prefix: file name prefix
+        :param block_size: number of scans per block handed to the writer
+        :param queue_size: max number of blocks waiting to be written
+        :param max_file_size: start a new file when the file reaches this size in bytes, <= 0 to disable
+        :param max_file_age: start a new file when the file is this old in seconds, <= 0 to disable
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.block_size = int(block_size)
+        self.max_file_size = max_file_size
+        self.max_file_age = max_file_age
+
+        self.dropped_blocks = 0
+        self.written_records = 0
+        self.current_file = ''
+        self.error = None
+
+        self._queue = queue.Queue(queue_size)
+        # Held by add while filling the block, so stop can take the partial block
+        self._lock = threading.Lock()
+        self._block = np.zeros(self.block_size, dtype=RECORD_DTYPE)
+        self._index = 0
+        self._file = None
+        self._file_start = 0.0
+        self._recording = False
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._write_blocks, name='AD7991 recorder')
+        self._thread.daemon = True
+
+    def start(self):
+        """
+        Open the first file and start the writer thread.
+        """
+        self._open_file()
+        self._recording = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """
+        Stop recording, write the partial block and close the file.
+        """
+        with self._lock:
+            if self._recording is False:
+                return
+            self._recording = False
+            # add() can not touch the partial block once it is swapped out
+            block, index = self._block, self._index
+            self._block = np.zeros(self.block_size, dtype=RECORD_DTYPE)
+            self._index = 0
+        if index > 0:
+            try:
+                self._queue.put((block, index), True, timeout)
+            except queue.Full:
+                self.dropped_blocks += 1
+        self._stop_flag = True
+        self._thread.join(timeout)
+
+    @property
+    def is_recording(self):
+        return self._recording
+
+    def add(self, timestamp, raw):
+        """
+        Add one scan. Called from the acquisition thread, never blocks.
+
+        :param timestamp: time of the scan, seconds since epoch
+        :param raw: sequence of N_CHANNELS raw ad results
+        """
+        with self._lock:
+            if self._recording is False:
+                return
+            record = self._block[self._index]
+            record['timestamp'] = timestamp
+            record['raw'] = raw
+            self._index += 1
+            if self._index == self.block_size:
+                try:
+                    self._queue.put_nowait((self._block, self._index))
+                    self._block = np.zeros(self.block_size, dtype=RECORD_DTYPE)
+                except queue.Full:
+                    # Reuse the block, its scans are lost
+                    self.dropped_blocks += 1
+                self._index = 0
+
+    def _open_file(self):
+        name = ''.join((self.prefix, '_', time.strftime('%Y%m%d_%H%M%S'), '.ad7991'))
+        filename = os.path.join(self.directory, name)
+        n = 1
+        while os.path.exists(filename):
+            filename = os.path.join(self.directory, ''.join((name[:-7], '_', str(n), '.ad7991')))
+            n += 1
+        self._file = open(filename, 'wb', 1 << 20)
+        self._file.write(_HEADER.pack(MAGIC, RECORD_DTYPE.itemsize, N_CHANNELS))
+        self._file_start = time.time()
+        self.current_file = filename
+        logger.info(''.join(('Recording to ', filename)))
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate_due(self):
+        if 0 < self.max_file_size <= self._file.tell():
+            return True
+        if 0 < self.max_file_age <= time.time() - self._file_start:
+            return True
+        return False
+
+    def _write_blocks(self):
+        while True:
+            try:
+                block, n_records = self._queue.get(True, 0.1)
+            except queue.Empty:
+                if self._stop_flag is True:
+                    break
+                continue
+            try:
+                # Rotate before writing, so the last file is never left empty
+                if self._rotate_due() is True:
+                    self._close_file()
+                    self._open_file()
+                self._file.write(block[:n_records].tobytes())
+                self.written_records += n_records
+            except (IOError, OSError) as e:
+                logger.error(''.join(('Error writing recording, ', str(e))))
+                self.error = e
+                self._recording = False
+                break
+        self._close_file()
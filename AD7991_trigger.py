@@ -0,0 +1,203 @@
+"""Created on 18 oct 2026
+
+Triggered capture of AD7991 scans with pre- and post-trigger windows.
+
+Trigger conditions are checked on the raw results of every scan, so a check
+costs a few integer comparisons. Levels given in volts are converted to raw
+codes once with the calibration table, see compile_conditions.
+
+Condition modes, with v the raw result and L the raw level:
+
+    above:      v >= L
+    below:      v < L
+    rising:     previous v < L <= v
+    falling:    previous v >= L > v
+
+@author: Filip Lindau
+"""
+import collections
+import threading
+import numpy as np
+
+TRIGGER_MODES = ['above', 'below', 'rising', 'falling']
+
+# Trigger condition with the level in volts, as parsed from a condition string
+TriggerSpec = collections.namedtuple('TriggerSpec', ['channel', 'mode', 'level'])
+
+# Trigger condition with the level as raw code
+TriggerCondition = collections.namedtuple('TriggerCondition', ['channel', 'mode', 'level'])
+
+# Captured window of raw scans. trigger_index is the position of the trigger scan.
+Capture = collections.namedtuple('Capture', ['trigger_time', 'trigger_channel', 'trigger_index', 'timestamps',
+                                             'raw'])
+
+
+def parse_conditions(text):
+    """
+    Parse trigger conditions of the form "<channel> <mode> <level in volts>",
+    separated by ';', e.g. "0 rising 1.5; 2 above 3.0". The trigger fires
+    when any condition is met.
+
+    :param text: condition string, empty for no conditions
+    :return: list of TriggerSpec
+    """
+    specs = []
+    for part in text.split(';'):
+        part = part.strip()
+        if part == '':
+            continue
+        fields = part.split()
+        try:
+            if len(fields) != 3:
+                raise ValueError
+            channel = int(fields[0])
+            mode = fields[1].lower()
+            level = float(fields[2])
+        except ValueError:
+            raise ValueError(''.join(('Invalid trigger condition "', part, '", should be "<channel> <mode> <level>"')))
+        if not 0 <= channel < 4:
+            raise ValueError(''.join(('Invalid trigger channel ', str(channel), ', must be 0..3')))
+        if mode not in TRIGGER_MODES:
+            raise ValueError(''.join(('Invalid trigger mode ', mode, ', must be one of ', ', '.join(TRIGGER_MODES))))
+        specs.append(TriggerSpec(channel, mode, level))
+    return specs
+
+
+def compile_conditions(specs, table):
+    """
+    Convert the levels of trigger specs from volts to raw codes, the first
+    code converting to at least the level.
+
+    :param specs: list of TriggerSpec
+    :param table: AD7991_calibration.CalibrationTable, must increase with the code
+    :return: list of TriggerCondition
+    """
+    conditions = []
+    for spec in specs:
+        level = int(np.searchsorted(table.lut[spec.channel], spec.level))
+        conditions.append(TriggerCondition(spec.channel, spec.mode, level))
+    return conditions
+
+
+class TriggerEngine(object):
+    def __init__(self, buffer, pre_samples=100, post_samples=100, conditions=None, auto_rearm=True):
+        """
+        Checks scans against trigger conditions. On a trigger the pre-trigger
+        window is copied from buffer, post_samples further scans are collected,
+        and add() returns the Capture.
+
+        add() must be called after the scan was appended to buffer, from the
+        thread filling the buffer. The other methods may be called from any thread.
+
+        :param buffer: AD7991_buffer.ScanRingBuffer holding the latest scans.
+            The pre-trigger window is limited to its depth.
+        :param pre_samples: scans before the trigger scan in a capture
+        :param post_samples: scans after the trigger scan in a capture
+        :param conditions: list of TriggerCondition, the trigger fires when any is met
+        :param auto_rearm: arm again after each capture, else wait for arm()
+        """
+        self.buffer = buffer
+        self.pre_samples = int(pre_samples)
+        self.post_samples = int(post_samples)
+        self.conditions = list(conditions) if conditions is not None else []
+        self.auto_rearm = auto_rearm
+        self.armed = True
+        self.captures = 0
+        self.lock = threading.Lock()
+
+        self._previous = None
+        self._pre = None
+        self._trigger = None
+        self._post_timestamps = np.zeros(self.post_samples, dtype=np.float64)
+        self._post_raw = np.zeros((self.post_samples, buffer.n_channels), dtype=np.uint16)
+        self._post_index = 0
+
+    def set_conditions(self, conditions):
+        conditions = list(conditions)
+        with self.lock:
+            self.conditions = conditions
+
+    def arm(self):
+        with self.lock:
+            self.armed = True
+
+    def reset(self):
+        """
+        Drop a capture in progress and forget the previous scan, e.g. when the
+        buffered scans were cleared. A dropped capture arms the trigger again
+        if auto_rearm is set.
+        """
+        with self.lock:
+            if self._trigger is not None:
+                self._trigger = None
+                self._pre = None
+                if self.auto_rearm is True:
+                    self.armed = True
+            self._previous = None
+
+    def disarm(self):
+        """
+        Stop triggering, dropping a capture in progress.
+        """
+        with self.lock:
+            self.armed = False
+            self._trigger = None
+            self._pre = None
+
+    def add(self, timestamp, raw):
+        """
+        Check one scan.
+
+        :param timestamp: time of the scan
+        :param raw: sequence of raw ad results
+        :return: Capture when the scan completed one, else None
+        """
+        with self.lock:
+            return self._add(timestamp, raw)
+
+    def _add(self, timestamp, raw):
+        previous = self._previous
+        self._previous = raw
+        if self._trigger is not None:
+            self._post_timestamps[self._post_index] = timestamp
+            self._post_raw[self._post_index, :] = raw
+            self._post_index += 1
+            if self._post_index == self.post_samples:
+                return self._finish()
+            return None
+        if self.armed is False or previous is None:
+            return None
+        for channel, mode, level in self.conditions:
+            value = raw[channel]
+            if mode == 'above':
+                fired = value >= level
+            elif mode == 'below':
+                fired = value < level
+            elif mode == 'rising':
+                fired = previous[channel] < level <= value
+            else:
+                fired = previous[channel] >= level > value
+            if fired:
+                self.armed = False
+                self._trigger = (timestamp, channel)
+                # The trigger scan is already in the buffer
+                self._pre = self.buffer.get_last(self.pre_samples + 1)
+                self._post_index = 0
+                if self.post_samples == 0:
+                    return self._finish()
+                return None
+        return None
+
+    def _finish(self):
+        # Call with lock held
+        trigger_time, trigger_channel = self._trigger
+        pre_timestamps, pre_raw = self._pre
+        capture = Capture(trigger_time, trigger_channel, len(pre_timestamps) - 1,
+                          np.concatenate((pre_timestamps, self._post_timestamps)),
+                          np.concatenate((pre_raw, self._post_raw)))
+        self._trigger = None
+        self._pre = None
+        self.captures += 1
+        if self.auto_rearm is True:
+            self.armed = True
+        return capture
@@ -9,14 +9,200 @@ import os
 import ctypes
 import array
 import fcntl
+import bisect
+import errno
 import numpy as np
 
+from AD7991_clock import monotonic
+
 
 class I2CError(IOError):
     """Base class for I2C errors."""
     pass
 
 
+class I2CDevBackend(object):
+    """Backend doing the system calls on a real i2c-dev device. I2C objects
+    can be given another backend with the same methods, for example the
+    simulated AD7991 in i2c_sim."""
+
+    def open(self, devpath):
+        return os.open(devpath, os.O_RDWR)
+
+    def ioctl(self, fd, request, arg, mutate_flag):
+        return fcntl.ioctl(fd, request, arg, mutate_flag)
+
+    def close(self, fd):
+        os.close(fd)
+
+
+_default_backend = I2CDevBackend()
+
+
+def set_default_backend(backend):
+    """Set the backend used by I2C objects created without an explicit
+    backend. Pass None to go back to the i2c-dev backend.
+
+    Args:
+        backend: object with open, ioctl and close methods like I2CDevBackend.
+
+    """
+    global _default_backend
+    if backend is None:
+        backend = I2CDevBackend()
+    _default_backend = backend
+
+
+def get_default_backend():
+    """Get the backend used by I2C objects created without an explicit backend."""
+    return _default_backend
+
+
+class I2CStatistics(object):
+    """Transfer counters and latency histogram of an I2C device. Cheap
+    enough to stay enabled: a transfer costs two clock reads, a bisect in
+    the bucket edges and a few integer additions.
+
+    Latencies are counted in fixed buckets, a quarter octave wide from 1 us
+    to about 1 s, so percentiles are accurate to about 10%. Updates are not
+    locked, transfers on one device are expected to be serialized by the
+    caller (e.g. the bus lock of AD7991_control.I2CBusManager).
+
+    Attributes:
+        transfers (int): successful I2C_RDWR ioctls.
+        bytes_read (int): bytes read in successful transfers.
+        bytes_written (int): bytes written in successful transfers.
+        errors (int): failed I2C_RDWR ioctls.
+        error_counts (dict): errno: number of failed ioctls.
+        retried_transfers (int): failed ioctls that a RetryPolicy retried.
+        failed_transfers (int): transfers that failed after the RetryPolicy gave up.
+        counts (list): number of transfers in each latency bucket.
+
+    """
+    # Upper edges of the latency buckets in s, the last bucket is unbounded
+    bucket_edges = [1e-6 * 2 ** (i / 4.0) for i in range(81)]
+    # Length of the time buckets transfer_rate counts transfers in, in s
+    rate_interval = 1.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear all counters."""
+        self.transfers = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.error_counts = {}
+        self.retried_transfers = 0
+        self.failed_transfers = 0
+        self.counts = [0] * (len(self.bucket_edges) + 1)
+        self._rate_bucket = int(monotonic() / self.rate_interval)
+        self._rate_count = 0        # Transfers in the current rate bucket
+        self._rate_previous = 0     # Transfers in the bucket before it
+
+    def add_transfer(self, latency, bytes_read, bytes_written, now=None):
+        """Count a successful transfer.
+
+        Args:
+            latency (float): duration of the ioctl in s.
+            bytes_read (int): bytes read.
+            bytes_written (int): bytes written.
+            now (float): monotonic() time at the end of the transfer, None to read the clock.
+
+        """
+        self.transfers += 1
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        self.counts[bisect.bisect_left(self.bucket_edges, latency)] += 1
+        if now is None:
+            now = monotonic()
+        bucket = int(now / self.rate_interval)
+        if bucket != self._rate_bucket:
+            # Only the previous bucket is kept, it is empty after a gap
+            self._rate_previous = self._rate_count if bucket == self._rate_bucket + 1 else 0
+            self._rate_bucket = bucket
+            self._rate_count = 0
+        self._rate_count += 1
+
+    def add_error(self, err):
+        self.errors += 1
+        self.error_counts[err] = self.error_counts.get(err, 0) + 1
+
+    def latency_percentile(self, q):
+        """Get the `q` percentile of the transfer latency in s, as the upper
+        edge of the bucket it falls in. 0.0 if there are no transfers.
+
+        Args:
+            q (float): percentile, 0-100.
+
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        limit = q / 100.0 * total
+        cumulative = 0
+        for i in range(len(counts)):
+            cumulative += counts[i]
+            if cumulative >= limit and cumulative > 0:
+                break
+        if i >= len(self.bucket_edges):
+            return float('inf')
+        return self.bucket_edges[i]
+
+    def transfer_rate(self):
+        """Get successful transfers per second over the last complete
+        rate_interval bucket. Does not depend on how often it is called."""
+        bucket = int(monotonic() / self.rate_interval)
+        if bucket == self._rate_bucket:
+            transfers = self._rate_previous
+        elif bucket == self._rate_bucket + 1:
+            transfers = self._rate_count
+        else:
+            transfers = 0
+        return transfers / self.rate_interval
+
+    def error_summary(self):
+        """Get the error counts as a string, e.g. "EIO: 3, ENXIO: 1"."""
+        return ', '.join(['%s: %d' % (errno.errorcode.get(err, str(err)), n)
+                          for err, n in sorted(self.error_counts.items(), key=lambda item: str(item[0]))])
+
+
+class RetryPolicy(object):
+    """Retry policy for transfers failing with a transient error, such as a
+    NAK or lost arbitration on a busy bus. A failed transfer is retried up to
+    `max_retries` times if its errno is in `transient_errnos`, sleeping
+    `backoff` * `backoff_factor` ** (retry - 1) s before each retry.
+
+    Args:
+        max_retries (int): retries after the first attempt, 0 to disable.
+        backoff (float): sleep before the first retry in s.
+        backoff_factor (float): growth of the sleep for each further retry.
+        transient_errnos (iterable): errnos worth retrying, defaults to
+            TRANSIENT_ERRNOS.
+
+    """
+    # NAK (ENXIO on the address, EREMOTEIO on data), lost arbitration (EAGAIN),
+    # bus busy or timed out, and EIO which some adapters use for all of these
+    TRANSIENT_ERRNOS = frozenset([errno.EAGAIN, errno.EBUSY, errno.EIO, errno.ENXIO, errno.EREMOTEIO,
+                                  errno.ETIMEDOUT])
+
+    def __init__(self, max_retries=2, backoff=0.0005, backoff_factor=2.0, transient_errnos=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.transient_errnos = frozenset(transient_errnos) if transient_errnos is not None else self.TRANSIENT_ERRNOS
+
+    def is_transient(self, err):
+        """Check if errno `err` is worth retrying."""
+        return err in self.transient_errnos
+
+    def retry_delay(self, retry):
+        """Get the sleep in s before retry number `retry`, counting from 1."""
+        return self.backoff * self.backoff_factor ** (retry - 1)
+
+
 class _CI2CMessage(ctypes.Structure):
     _fields_ = [
         ("addr", ctypes.c_ushort),
@@ -46,13 +232,19 @@ class I2C(object):
     _I2C_M_IGNORE_NAK   = 0x1000
     _I2C_M_NO_RD_ACK    = 0x0800
     _I2C_M_RECV_LEN     = 0x0400
+    _I2C_RDWR_IOCTL_MAX_MSGS = 42
 
-    def __init__(self, devpath):
+    def __init__(self, devpath, backend=None, statistics=None):
         """Instantiate an I2C object and open the i2c-dev device at the
         specified path.
 
         Args:
             devpath (str): i2c-dev device path.
+            backend: backend doing the system calls, defaults to the one
+                set with set_default_backend.
+            statistics (I2CStatistics): counters updated by the transfers,
+                a new I2CStatistics if None. Passing the same object keeps
+                the counts when the device is reopened.
 
         Returns:
             I2C: I2C object.
@@ -63,6 +255,8 @@ class I2C(object):
         """
         self._fd = None
         self._devpath = None
+        self._backend = backend if backend is not None else _default_backend
+        self.statistics = statistics if statistics is not None else I2CStatistics()
         self._open(devpath)
 
     def __del__(self):
@@ -77,7 +271,7 @@ class I2C(object):
     def _open(self, devpath):
         # Open i2c device
         try:
-            self._fd = os.open(devpath, os.O_RDWR)
+            self._fd = self._backend.open(devpath)
         except OSError as e:
             raise I2CError(e.errno, "Opening I2C device: " + e.strerror)
 
@@ -86,7 +280,7 @@ class I2C(object):
         # Query supported functions
         buf = array.array('I', [0])
         try:
-            fcntl.ioctl(self._fd, I2C._I2C_IOC_FUNCS, buf, True)
+            self._backend.ioctl(self._fd, I2C._I2C_IOC_FUNCS, buf, True)
         except OSError as e:
             self.close()
             raise I2CError(e.errno, "Querying supported functions: " + e.strerror)
@@ -119,6 +313,8 @@ class I2C(object):
 
         # Convert I2C.Message messages to _CI2CMessage messages
         cmessages = (_CI2CMessage * len(messages))()
+        bytes_read = 0
+        bytes_written = 0
         for i in range(len(messages)):
             # Convert I2C.Message data to bytes
             if isinstance(messages[i].data, bytes):
@@ -128,10 +324,14 @@ class I2C(object):
             elif isinstance(messages[i].data, list):
                 data = bytes(bytearray(messages[i].data))
 
-            cmessages[i].addr = address
+            cmessages[i].addr = address if messages[i].addr is None else messages[i].addr
             cmessages[i].flags = messages[i].flags | (I2C._I2C_M_RD if messages[i].read else 0)
             cmessages[i].len = len(data)
             cmessages[i].buf = ctypes.cast(ctypes.create_string_buffer(data, len(data)), ctypes.POINTER(ctypes.c_ubyte))
+            if messages[i].read:
+                bytes_read += len(data)
+            else:
+                bytes_written += len(data)
 
         # Prepare transfer structure
         i2c_xfer = _CI2CIocTransfer()
@@ -139,10 +339,7 @@ class I2C(object):
         i2c_xfer.msgs = cmessages
 
         # Transfer
-        try:
-            fcntl.ioctl(self._fd, I2C._I2C_IOC_RDWR, i2c_xfer, False)
-        except IOError as e:
-            raise I2CError(e.errno, "I2C transfer: " + e.strerror)
+        self._rdwr(i2c_xfer, bytes_read, bytes_written)
 
         # Update any read I2C.Message messages
         for i in range(len(messages)):
@@ -156,6 +353,30 @@ class I2C(object):
                 elif isinstance(messages[i].data, bytes):
                     messages[i].data = bytes(bytearray(data))
 
+    def transfer_prepared(self, prepared):
+        """Run a transfer built once with I2C.PreparedTransfer. The ctypes
+        message array and data buffers are reused, and read results land
+        directly in the transfer's `buffers`.
+
+        Args:
+            prepared (I2C.PreparedTransfer): transfer to run.
+
+        Raises:
+            I2CError: if an I/O or OS error occurs.
+
+        """
+        self._rdwr(prepared._xfer, prepared.bytes_read, prepared.bytes_written)
+
+    def _rdwr(self, i2c_xfer, bytes_read, bytes_written):
+        t_start = monotonic()
+        try:
+            self._backend.ioctl(self._fd, I2C._I2C_IOC_RDWR, i2c_xfer, False)
+        except IOError as e:
+            self.statistics.add_error(e.errno)
+            raise I2CError(e.errno, "I2C transfer: " + e.strerror)
+        t_end = monotonic()
+        self.statistics.add_transfer(t_end - t_start, bytes_read, bytes_written, t_end)
+
     def close(self):
         """Close the i2c-dev I2C device.
 
@@ -167,7 +388,7 @@ class I2C(object):
             return
 
         try:
-            os.close(self._fd)
+            self._backend.close(self._fd)
         except OSError as e:
             raise I2CError(e.errno, "Closing I2C device: " + e.strerror)
 
@@ -183,6 +404,14 @@ class I2C(object):
         """
         return self._fd
 
+    @property
+    def backend(self):
+        """Get the backend doing the system calls.
+
+        :type: I2CDevBackend
+        """
+        return self._backend
+
     @property
     def devpath(self):
         """Get the device path of the underlying i2c-dev device.
@@ -197,13 +426,15 @@ class I2C(object):
         return "I2C (device=%s, fd=%d)" % (self.devpath, self.fd)
 
     class Message:
-        def __init__(self, data, read=False, flags=0):
+        def __init__(self, data, read=False, flags=0, addr=None):
             """Instantiate an I2C Message object.
 
             Args:
                 data (bytes, bytearray, list): a byte array or list of 8-bit integers to write.
                 read (bool): specify this as a read transaction, where `data` serves as placeholder bytes for the read.
                 flags (int): additional i2c-dev flags.
+                addr (int): I2C address of this message, overriding the address
+                    given to the transfer. Lets one transfer address several devices.
 
             Returns:
                 Message: Message object.
@@ -218,10 +449,73 @@ class I2C(object):
                 raise TypeError("Invalid read type, should be boolean.")
             if not isinstance(flags, int):
                 raise TypeError("Invalid flags type, should be integer.")
+            if addr is not None and not isinstance(addr, int):
+                raise TypeError("Invalid addr type, should be integer or None.")
 
             self.data = data
             self.read = read
             self.flags = flags
+            self.addr = addr
+
+    class PreparedTransfer:
+        def __init__(self, address, messages):
+            """Instantiate a reusable transfer of `messages` to the I2C `address`.
+            The ctypes message array and data buffers are built once. Each
+            message gets a bytearray in `buffers` that the ctypes buffer shares
+            memory with, so data to write can be updated in place and read
+            results are available without copying.
+
+            Args:
+                address (int): I2C address.
+                messages (list): list of I2C.Message messages.
+
+            Returns:
+                PreparedTransfer: PreparedTransfer object.
+
+            Raises:
+                TypeError: if `messages` type is not list.
+                ValueError: if `messages` length is zero, or if a message has no data.
+
+            """
+            if not isinstance(messages, list):
+                raise TypeError("Invalid messages type, should be list of I2C.Message.")
+            elif len(messages) == 0:
+                raise ValueError("Invalid messages data, should be non-zero length.")
+
+            self.address = address
+            self.buffers = []
+            self.bytes_read = 0
+            self.bytes_written = 0
+            self._cbuffers = []
+            self._cmessages = (_CI2CMessage * len(messages))()
+            for i in range(len(messages)):
+                data = bytearray(messages[i].data)
+                if len(data) == 0:
+                    raise ValueError("Invalid message data, should be non-zero length.")
+                cbuf = (ctypes.c_ubyte * len(data)).from_buffer(data)
+
+                self._cmessages[i].addr = address if messages[i].addr is None else messages[i].addr
+                self._cmessages[i].flags = messages[i].flags | (I2C._I2C_M_RD if messages[i].read else 0)
+                self._cmessages[i].len = len(data)
+                self._cmessages[i].buf = ctypes.cast(cbuf, ctypes.POINTER(ctypes.c_ubyte))
+                # Keep the ctypes views alive for as long as the message array refers to them
+                self._cbuffers.append(cbuf)
+                self.buffers.append(data)
+                if messages[i].read:
+                    self.bytes_read += len(data)
+                else:
+                    self.bytes_written += len(data)
+
+            self._xfer = _CI2CIocTransfer()
+            self._xfer.nmsgs = len(messages)
+            self._xfer.msgs = self._cmessages
+
+        def view(self, index):
+            """Get a memoryview of the data buffer of message `index`.
+
+            :rtype: memoryview
+            """
+            return memoryview(self.buffers[index])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,255 @@
+''' Simulated i2c-dev backend with AD7991 devices, for running and
+benchmarking AD7991Control and the device server without hardware.
+
+    backend = SimulatedAD7991Backend(byte_time=22.5e-6)
+    ad7991 = AD7991Control(0x28, 1, backend=backend)
+
+or use i2c_per.set_default_backend(backend) to simulate every I2C object.
+
+Created on 18 oct 2026
+
+@author: Filip Lindau
+'''
+
+import ctypes
+import errno
+import math
+import os
+import random
+import threading
+import time
+
+from i2c_per import I2C
+
+
+class SimulatedAD7991(object):
+    def __init__(self, signals=None, vcc=3.3, vref_ext=2.0, noise=0.0):
+        """Instantiate a simulated AD7991.
+
+        Args:
+            signals (list): four input signals in volts, each a constant or a
+                function of time. Defaults to slow sine waves.
+            vcc (float): supply voltage, used as reference when REF_SEL is 0.
+            vref_ext (float): external reference voltage on VIN3, used when REF_SEL is 1.
+            noise (float): standard deviation of gaussian noise added to the inputs, in volts.
+
+        """
+        if signals is None:
+            signals = [self._sine(1.0 + 0.5 * ch, 0.1 * (ch + 1)) for ch in range(4)]
+        self.signals = list(signals)
+        self.vcc = vcc
+        self.vref_ext = vref_ext
+        self.noise = noise
+        self.config = 0xf0      # Power-up default, all channels enabled
+        self.conversions = 0
+        self._next_channel = 0
+
+    @staticmethod
+    def _sine(offset, frequency):
+        return lambda t: offset + 0.5 * math.sin(2 * math.pi * frequency * t)
+
+    def enabled_channels(self):
+        """Get the channels converted in round-robin order. VIN3 is the
+        reference input when REF_SEL is set. With no channel selected VIN0 is converted.
+
+        :rtype: list
+        """
+        channels = [ch for ch in range(4) if self.config & (0x10 << ch)]
+        if self.config & 0x08:
+            channels = [ch for ch in channels if ch != 3]
+        if len(channels) == 0:
+            channels = [0]
+        return channels
+
+    def write(self, data):
+        """Write bytes to the device. The last byte written is the config
+        register. Restarts the round-robin sequence."""
+        if len(data) > 0:
+            self.config = data[-1]
+            self._next_channel = 0
+
+    def read(self, length):
+        """Read `length` bytes of conversion results, two bytes per conversion
+        with the channel id in bits 12-13.
+
+        :rtype: bytearray
+        """
+        channels = self.enabled_channels()
+        vref = self.vref_ext if self.config & 0x08 else self.vcc
+        t = time.time()
+        data = bytearray(length)
+        for i in range(0, length, 2):
+            ch = channels[self._next_channel % len(channels)]
+            self._next_channel += 1
+            self.conversions += 1
+            signal = self.signals[ch]
+            voltage = signal(t) if callable(signal) else signal
+            if self.noise > 0:
+                voltage += random.gauss(0.0, self.noise)
+            code = int(round(voltage / vref * 4095))
+            word = (ch << 12) | min(max(code, 0), 4095)
+            data[i] = word >> 8
+            if i + 1 < length:
+                data[i + 1] = word & 0xff
+        return data
+
+
+class SimulatedAD7991Backend(object):
+    def __init__(self, devices=None, bus_latency=0.0, byte_time=0.0, conversion_time=0.0, buses=None):
+        """Instantiate an i2c_per backend simulating AD7991 devices.
+
+        Args:
+            devices (dict): simulated devices keyed by address, or by
+                (devpath, address) for a device on one bus only. If None, a
+                SimulatedAD7991 is created for any address on first access.
+            bus_latency (float): fixed time per I2C_RDWR transfer, in seconds.
+            byte_time (float): time per transferred byte, 22.5e-6 for a 400 kHz bus.
+            conversion_time (float): extra time per conversion read.
+            buses (list): device paths that exist, None to accept any path.
+
+        """
+        self.auto_create = devices is None
+        self.devices = dict(devices) if devices is not None else {}
+        self.bus_latency = bus_latency
+        self.byte_time = byte_time
+        self.conversion_time = conversion_time
+        self.buses = buses
+
+        # Fault injection, see fail_next
+        self.error_rate = 0.0
+        self.error_errno = errno.EIO
+        self._fail_count = 0
+        self._fail_errno = errno.EIO
+
+        self._lock = threading.Lock()
+        self._bus_locks = {}
+        self._fds = {}
+        self._next_fd = 1000
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.opens = 0
+        self.closes = 0
+        self.ioctls = 0
+        self.transfers = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.errors = 0
+
+    @property
+    def syscalls(self):
+        """Get the number of open, ioctl and close calls since the counters were reset.
+
+        :type: int
+        """
+        return self.opens + self.ioctls + self.closes
+
+    def fail_next(self, count=1, err=errno.EIO):
+        """Make the next `count` I2C_RDWR transfers fail with errno `err`."""
+        with self._lock:
+            self._fail_count = count
+            self._fail_errno = err
+
+    def get_device(self, devpath, address):
+        with self._lock:
+            device = self.devices.get((devpath, address))
+            if device is None:
+                device = self.devices.get(address)
+            if device is None and self.auto_create is True:
+                device = SimulatedAD7991()
+                self.devices[address] = device
+            return device
+
+    # Backend interface, see i2c_per.I2CDevBackend
+
+    def open(self, devpath):
+        if self.buses is not None and devpath not in self.buses:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        with self._lock:
+            self.opens += 1
+            fd = self._next_fd
+            self._next_fd += 1
+            self._fds[fd] = devpath
+            if devpath not in self._bus_locks:
+                self._bus_locks[devpath] = threading.Lock()
+        return fd
+
+    def close(self, fd):
+        with self._lock:
+            self.closes += 1
+            if fd not in self._fds:
+                raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+            del self._fds[fd]
+
+    def ioctl(self, fd, request, arg, mutate_flag):
+        with self._lock:
+            self.ioctls += 1
+            devpath = self._fds.get(fd)
+        if devpath is None:
+            raise IOError(errno.EBADF, os.strerror(errno.EBADF))
+        if request == I2C._I2C_IOC_FUNCS:
+            arg[0] = I2C._I2C_FUNC_I2C
+            return 0
+        elif request == I2C._I2C_IOC_RDWR:
+            self._rdwr(devpath, arg)
+            return 0
+        raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+    def _rdwr(self, devpath, i2c_xfer):
+        err = None
+        with self._lock:
+            self.transfers += 1
+            if self._fail_count > 0:
+                self._fail_count -= 1
+                err = self._fail_errno
+            elif self.error_rate > 0 and random.random() < self.error_rate:
+                err = self.error_errno
+            if err is not None:
+                self.errors += 1
+        if err is not None:
+            raise IOError(err, os.strerror(err))
+
+        # The bus carries one transfer at a time
+        with self._bus_locks[devpath]:
+            n_bytes = 0
+            n_conversions = 0
+            for i in range(i2c_xfer.nmsgs):
+                msg = i2c_xfer.msgs[i]
+                device = self.get_device(devpath, msg.addr)
+                if device is None:
+                    with self._lock:
+                        self.errors += 1
+                    raise IOError(errno.ENXIO, os.strerror(errno.ENXIO))
+                if msg.flags & I2C._I2C_M_RD:
+                    data = bytes(device.read(msg.len))
+                    ctypes.memmove(msg.buf, data, msg.len)
+                    n_conversions += msg.len // 2
+                    with self._lock:
+                        self.bytes_read += msg.len
+                else:
+                    device.write(bytearray(ctypes.string_at(msg.buf, msg.len)))
+                    with self._lock:
+                        self.bytes_written += msg.len
+                # Address byte plus data
+                n_bytes += msg.len + 1
+            delay = self.bus_latency + n_bytes * self.byte_time + n_conversions * self.conversion_time
+            if delay > 0:
+                time.sleep(delay)
+
+
+_shared_backend = None
+_shared_backend_lock = threading.Lock()
+
+
+def get_shared_backend():
+    """Get a process wide SimulatedAD7991Backend, created on first use, with
+    a simulated AD7991 on every address. Used by device servers running in
+    simulation mode so that devices on the same bus share the simulated bus.
+
+    :rtype: SimulatedAD7991Backend
+    """
+    global _shared_backend
+    with _shared_backend_lock:
+        if _shared_backend is None:
+            _shared_backend = SimulatedAD7991Backend()
+        return _shared_backend